@@ -1,5 +1,15 @@
 #!/usr/bin/env python
 
+import os
+
 import setuptools
 
-setuptools.setup()
+ext_modules = []
+if os.environ.get("PARAMETER_EXPANSION_MYPYC"):
+    # Compile the core module with mypyc. The pure Python module is used when
+    # it is not compiled, see parameter_expansion.pe.BACKEND.
+    from mypyc.build import mypycify
+
+    ext_modules = mypycify(["src/parameter_expansion/_core.py"])
+
+setuptools.setup(ext_modules=ext_modules)
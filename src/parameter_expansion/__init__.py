@@ -1 +1,18 @@
-from .pe import ParameterExpansionNullError, expand
+from .pe import (
+    Expander,
+    FrozenEnv,
+    ParameterExpansionNullError,
+    Problem,
+    Template,
+    compile,
+    dump_templates,
+    expand,
+    expand_column,
+    expand_file,
+    expand_script,
+    expand_with_spans,
+    expansion_stats,
+    freeze,
+    load_templates,
+    validate,
+)
@@ -0,0 +1,653 @@
+"""
+The core of parameter_expansion: the parser of shell strings into template
+parts, pattern matching and the expansion of simple references.
+
+This module is the pure Python fallback of an optional build compiled with
+mypyc (see setup.py) and is typed for that purpose. It must not import the
+rest of the package. See ``parameter_expansion.pe.BACKEND``.
+"""
+
+import os
+import re
+from fnmatch import translate
+from typing import Any, Callable, Dict, List, Mapping, Optional, Sequence, Tuple
+
+
+class ParameterExpansionNullError(LookupError):
+    pass
+
+
+class ParameterExpansionParseError(Exception):
+    pass
+
+
+# Parts are literal strings or node tuples, see below.
+Parts = Tuple[Any, ...]
+
+# The letters of ${foo@U} transformation operators.
+_TRANSFORM_LETTERS = frozenset("UuLQE")
+
+
+#
+# Parsing: a shell string is parsed in a single pass into a tuple of parts that
+# are either literal strings or expansion nodes. Nodes are tuples where the
+# first item is the node kind:
+#
+#  - ("$", word): a plain $word parameter. The longest leading part of word
+#    that is a parameter name in the env is expanded and the rest is kept as
+#    literal text, as in "$foobar" with foo="x" that expands to "xbar".
+#  - ("{", name, index, op, word, extra): a ${name[index]<op>word} expression.
+#    name is either a string or a tuple of parts for composed names such as
+#    ${foo${bar}}. index is None, "@" or "*" for all the elements of an array,
+#    or a tuple of parts for a subscript. op is one of "", "-", ":-", "=",
+#    ":=", "?", ":?", "+", ":+", "%", "%%", "#", "##", "/", "//", "/#", "/%",
+#    "^", "^^", ",", ",,", "@" followed by a transformation letter or ":" for
+#    substrings. word and extra are tuples of parts: extra is the replacement
+#    string of "/" operators or the substring length of ":" and may be None
+#    when absent.
+#  - ("!", name, index, op, word, extra): a ${!name} indirect expansion, with
+#    the same items as a "{" node.
+#  - ("#", name, index): the ${#name} length of a parameter or the number of
+#    elements of an array.
+#  - ("!*", prefix, sep): the ${!prefix*} or ${!prefix@} names starting with
+#    prefix.
+#  - ("![", name, sep): the ${!name[*]} or ${!name[@]} keys of an array.
+#  - ("((", parts): a $((...)) arithmetic expansion of the expression in parts.
+#  - ("q", node): a quoted expansion in a pattern that is matched literally.
+#  - ("~", user): a ~ or ~user tilde prefix at the start of a string.
+#
+# Names are also the positional parameters as in $1 or ${10} and the special
+# parameters as in $# or ${@}, see _special_parameter().
+#
+
+_match_name = re.compile(r"\w+", re.ASCII).match
+
+# the name of a positional parameter: str.isdigit() is also true for non-ASCII
+# digits that int() does not parse
+_match_number = re.compile(r"[0-9]+\Z").match
+
+# a ~ or ~user tilde prefix followed by a slash or the end of the string
+_match_tilde = re.compile(r"~([\w.-]*)(?=/|\Z)", re.ASCII).match
+
+# the names of the special parameters and of the single digit positional
+# parameters of a $name expansion as in $1 or $#
+_SINGLE_NAMES = frozenset("0123456789@*#?$")
+
+# The characters that end the unquoted value of an assignment: blanks and
+# the shell control operators.
+_VALUE_STOPS = " \t\n;&|<>"
+
+# match runs of plain characters in a word, by stop characters
+_word_runs = {
+    stops: re.compile("[^$\\\\'\"" + re.escape(stops) + "]+").match
+    for stops in ("}", ":}", "/}", "]", "", _VALUE_STOPS)
+}
+_double_quoted_runs = re.compile(r'[^$\\"]+').match
+
+
+def _parse(s: str, spans: Optional[List[Tuple[int, int]]] = None) -> Parts:
+    """Return a tuple of template parts parsed from the shell string s.
+    If spans is a list, append the (start, end) span of each part to it.
+    """
+    parts: List[Any] = []
+    pos = 0
+    literal_start = 0
+    if s.startswith("~"):
+        node, end = _parse_tilde(s)
+        if node is not None:
+            parts.append(node)
+            if spans is not None:
+                spans.append((0, end))
+            pos = literal_start = end
+    find = s.find
+    while True:
+        dollar = find("$", pos)
+        if dollar < 0:
+            break
+        node, end = _parse_dollar(s, dollar)
+        if node is None:
+            pos = end
+            continue
+        if literal_start < dollar:
+            parts.append(s[literal_start:dollar])
+            if spans is not None:
+                spans.append((literal_start, dollar))
+        parts.append(node)
+        if spans is not None:
+            spans.append((dollar, end))
+        pos = literal_start = end
+    if literal_start < len(s):
+        parts.append(s[literal_start:])
+        if spans is not None:
+            spans.append((literal_start, len(s)))
+    return tuple(parts)
+
+
+def _parse_dollar(s: str, pos: int) -> Tuple[Any, int]:
+    """Return a tuple of (node, end) for the expansion starting at the dollar
+    sign at index pos of s, or (None, pos + 1) if this dollar sign does not
+    start an expansion and is a literal.
+    """
+    start = pos + 1
+    if start < len(s):
+        if s[start] in _SINGLE_NAMES:
+            return ("$", s[start]), start + 1
+        match = _match_name(s, start)
+        if match:
+            return ("$", match.group()), match.end()
+        if s[start] == "{":
+            node, end = _parse_brace(s, start + 1)
+            if node is not None:
+                return node, end
+        elif s.startswith("((", start):
+            node, end = _parse_arithmetic(s, start + 2)
+            if node is not None:
+                return node, end
+    return None, start
+
+
+def _parse_tilde(s: str) -> Tuple[Any, int]:
+    """Return a tuple of (node, end) for the ~ or ~user tilde prefix at the
+    start of s, or (None, 0) if s does not start with a tilde prefix.
+    """
+    match = _match_tilde(s)
+    if not match:
+        return None, 0
+    return ("~", match.group(1)), match.end()
+
+
+_arithmetic_runs = re.compile(r"[^$()]+").match
+
+
+def _parse_arithmetic(s: str, pos: int) -> Tuple[Any, int]:
+    """Return a tuple of (node, end) for the $((...)) arithmetic expansion
+    whose expression starts at index pos of s. node is None if the expression
+    is not terminated.
+    """
+    parts: List[Any] = []
+    literal: List[str] = []
+    depth = 0
+    size = len(s)
+    while pos < size:
+        match = _arithmetic_runs(s, pos)
+        if match:
+            literal.append(match.group())
+            pos = match.end()
+            continue
+        char = s[pos]
+        if char == "$":
+            node, end = _parse_dollar(s, pos)
+            if node is None:
+                literal.append(char)
+            else:
+                if literal:
+                    parts.append("".join(literal))
+                    literal = []
+                parts.append(node)
+            pos = end
+            continue
+        if char == ")":
+            if not depth:
+                if not s.startswith("))", pos):
+                    return None, pos
+                if literal:
+                    parts.append("".join(literal))
+                return ("((", tuple(parts)), pos + 2
+            depth -= 1
+        else:
+            depth += 1
+        literal.append(char)
+        pos += 1
+    return None, size
+
+
+def _parse_name(s: str, pos: int) -> Tuple[Any, int]:
+    """Return a tuple of (name, end) for the parameter name starting at index
+    pos of s. name is None if there is no name.
+    """
+    parts: List[Any] = []
+    while pos < len(s):
+        match = _match_name(s, pos)
+        if match:
+            parts.append(match.group())
+            pos = match.end()
+            continue
+        if s[pos] == "$":
+            node, end = _parse_dollar(s, pos)
+            if node is not None:
+                parts.append(node)
+                pos = end
+                continue
+        break
+    if not parts:
+        return None, pos
+    if len(parts) == 1 and isinstance(parts[0], str):
+        return parts[0], pos
+    return tuple(parts), pos
+
+
+def _parse_brace(s: str, pos: int) -> Tuple[Any, int]:
+    """Return a tuple of (node, end) for the ${...} expression whose content
+    starts at index pos of s. node is None if the expression is empty or not
+    terminated.
+    """
+    size = len(s)
+    start = pos
+    kind = "{"
+    if pos + 1 < size and s[pos] in "#!" and s[pos + 1] != "}":
+        kind = s[pos]
+        pos += 1
+
+    special = s[pos] if pos < size and s[pos] in "@*#?$" else ""
+    if special == "$" and _parse_dollar(s, pos)[0] is not None:
+        # this is a composed name as in ${$foo}
+        special = ""
+    name: Any = special
+    index: Any = None
+    if special:
+        # a special parameter as in ${#} or ${@:2}
+        end = pos + 1
+    else:
+        name, end = _parse_name(s, pos)
+        if name is None or end >= size:
+            return None, end
+        index, end = _parse_subscript(s, end)
+    if end >= size:
+        return None, end
+
+    if kind == "#":
+        if s[end] != "}":
+            raise ParameterExpansionParseError("Bad substitution", s[start - 2 : end])
+        return ("#", name, index), end + 1
+
+    if kind == "!":
+        if index is None and s[end] in "*@" and s.startswith("}", end + 1):
+            # ${!prefix*} and ${!prefix@} list the names starting with prefix
+            return ("!*", name, s[end]), end + 2
+        if index in ("@", "*") and s[end] == "}":
+            # ${!name[@]} and ${!name[*]} list the keys of an array
+            return ("![", name, index), end + 1
+
+    op = s[end]
+    extra = None
+    if op == "}":
+        return (kind, name, index, "", (), None), end + 1
+
+    if op == ":":
+        end += 1
+        if end < size and s[end] in "-=?+":
+            op += s[end]
+            word, end = _parse_word(s, end + 1, "}")
+        else:
+            # This is a Substring Expansion as in ${foo:4:2}, ${foo::2},
+            # ${foo:4:} or ${foo:4:2} in the general form of
+            # ${parameter:start:length}. This is a bash'ism, and not POSIX.
+            word, end = _parse_word(s, end, ":}")
+            if end < size and s[end] == ":":
+                extra, end = _parse_word(s, end + 1, "}")
+    elif op in "-=?+":
+        word, end = _parse_word(s, end + 1, "}")
+    elif op in "%#":
+        end += 1
+        if s.startswith(op, end):
+            op += op
+            end += 1
+        word, end = _parse_word(s, end, "}", pattern=True)
+    elif op == "/":
+        # This is a string replacement as in ${foo/bar/baz}. With // replace
+        # all occurrences and with /# or /% replace a prefix or a suffix. The
+        # replacement string may be empty or absent.
+        end += 1
+        if end < size and s[end] in "/#%":
+            op += s[end]
+            end += 1
+        if op in ("/", "//") and s.startswith("/", end):
+            # a pattern may start with a slash as in ${foo///}
+            word, end = _parse_word(s, end + 1, "/}")
+            if word is not None:
+                word = ("/",) + word
+        else:
+            word, end = _parse_word(s, end, "/}")
+        if end < size and s[end] == "/":
+            extra, end = _parse_word(s, end + 1, "}")
+    elif op in "^,":
+        # This is a case modification as in ${foo^^} or ${foo,[abc]}.
+        end += 1
+        if s.startswith(op, end):
+            op += op
+            end += 1
+        word, end = _parse_word(s, end, "}", pattern=True)
+    elif op == "@" and s[end + 1 : end + 2] in _TRANSFORM_LETTERS:
+        # This is a transformation as in ${foo@U}.
+        op += s[end + 1]
+        word = ()
+        end += 2
+    else:
+        raise ParameterExpansionParseError("Bad substitution", s[start - 2 : end + 1])
+
+    if word is None or end >= size:
+        return None, end
+    return (kind, name, index, op, word, extra), end + 1
+
+
+def _parse_subscript(s: str, pos: int) -> Tuple[Any, int]:
+    """Return a tuple of (index, end) for the optional [subscript] of an array
+    parameter at index pos of s. index is None if there is no subscript, "@"
+    or "*" for all the elements or a tuple of parts otherwise.
+    """
+    if not s.startswith("[", pos):
+        return None, pos
+    if s.startswith(("@]", "*]"), pos + 1):
+        return s[pos + 1], pos + 3
+    index, end = _parse_word(s, pos + 1, "]")
+    if index is None:
+        return None, len(s)
+    return index, end + 1
+
+
+def _glob_escape(s: str) -> str:
+    """Return s with pattern matching characters escaped."""
+    return re.sub(r"([*?[])", r"[\1]", s)
+
+
+def _parse_word(
+    s: str, pos: int, stops: str, pattern: bool = False
+) -> Tuple[Optional[Parts], int]:
+    """Return a tuple of (parts, end) for the word starting at index pos of s
+    and ending at one of the ``stops`` characters at index end, or at the end
+    of s if ``stops`` is empty. parts is None if the word is not terminated.
+
+    Quotes are removed and quoted text is not expanded in single quotes. If
+    pattern is True, quoted text is escaped to match literally.
+    """
+    parts: List[Any] = []
+    literal: List[str] = []
+    size = len(s)
+    match_run = _word_runs[stops]
+    while pos < size:
+        match = match_run(s, pos)
+        if match:
+            literal.append(match.group())
+            pos = match.end()
+            continue
+        char = s[pos]
+        if char in stops:
+            break
+        if char == "$":
+            node, end = _parse_dollar(s, pos)
+            if node is None:
+                literal.append(char)
+            else:
+                if literal:
+                    parts.append("".join(literal))
+                    literal = []
+                parts.append(node)
+            pos = end
+        elif char == "\\":
+            escaped = s[pos + 1 : pos + 2] or char
+            literal.append(_glob_escape(escaped) if pattern else escaped)
+            pos += 2
+        elif char == "'":
+            end = s.find("'", pos + 1)
+            if end < 0:
+                return None, size
+            quoted = s[pos + 1 : end]
+            literal.append(_glob_escape(quoted) if pattern else quoted)
+            pos = end + 1
+        else:
+            # double quotes: expansions are still performed
+            pos += 1
+            while pos < size and s[pos] != '"':
+                match = _double_quoted_runs(s, pos)
+                if match:
+                    quoted = match.group()
+                    literal.append(_glob_escape(quoted) if pattern else quoted)
+                    pos = match.end()
+                elif s[pos] == "$":
+                    node, end = _parse_dollar(s, pos)
+                    if node is None:
+                        literal.append("$")
+                    else:
+                        if literal:
+                            parts.append("".join(literal))
+                            literal = []
+                        parts.append(("q", node) if pattern else node)
+                    pos = end
+                else:
+                    # a backslash only escapes these in double quotes
+                    escaped = s[pos + 1 : pos + 2]
+                    if escaped not in ("$", "`", '"', "\\", ""):
+                        escaped = "\\" + escaped
+                    literal.append(_glob_escape(escaped) if pattern else escaped)
+                    pos += 2
+            if pos >= size:
+                return None, size
+            pos += 1
+    else:
+        if stops:
+            return None, size
+    if literal:
+        parts.append("".join(literal))
+    return tuple(parts), pos
+
+
+# The operators of the dialects other than bash, see _parse_dialect().
+_DIALECT_OPERATORS = {
+    "posix": frozenset(
+        ["", "-", ":-", "=", ":=", "?", ":?", "+", ":+", "%", "%%", "#", "##"]
+    ),
+    "compose": frozenset(["", "-", ":-", "?", ":?", "+", ":+"]),
+    "envsubst": frozenset([""]),
+}
+
+_DIALECT_ERRORS = {
+    "posix": "Bad substitution",
+    "compose": "Invalid interpolation format",
+}
+
+
+def _parse_dialect(
+    s: str, dialect: str, spans: Optional[List[Tuple[int, int]]] = None
+) -> Parts:
+    """Return a tuple of template parts parsed from the shell string s with
+    the rules of a dialect. If spans is a list, append the (start, end) span
+    of each part to it.
+
+    The "bash" dialect is parsed with _parse(). In the other dialects a $name
+    expansion is converted to a ${name} expansion of the whole name that is
+    empty when unset, and the nodes are checked once at parse time so that
+    evaluation needs no dialect checks:
+
+    - "posix" only has the POSIX operators, ${#name}, $((...)), the positional
+      and special parameters and tilde prefixes and raises a
+      ParameterExpansionParseError on other expansions.
+    - "compose" has the docker-compose operators and $$ for a literal dollar
+      sign outside of braces and raises on other expansions, including the
+      positional and special parameters.
+    - "envsubst" only has $name and ${name} and keeps other text as is.
+    """
+    if dialect == "bash":
+        return _parse(s, spans)
+    operators = _DIALECT_OPERATORS.get(dialect)
+    if operators is None:
+        raise ValueError(f"Unknown dialect: {dialect!r}")
+    envsubst = dialect == "envsubst"
+    escape = dialect == "compose"
+    parts: List[Any] = []
+    literal: List[str] = []
+    pos = 0
+    literal_start = 0
+    if dialect == "posix" and s.startswith("~"):
+        node, end = _parse_tilde(s)
+        if node is not None:
+            parts.append(node)
+            if spans is not None:
+                spans.append((0, end))
+            pos = literal_start = end
+    find = s.find
+    while True:
+        dollar = find("$", pos)
+        if dollar < 0:
+            break
+        literal.append(s[pos:dollar])
+        if escape and s.startswith("$$", dollar):
+            literal.append("$")
+            pos = dollar + 2
+            continue
+        try:
+            node, end = _parse_dollar(s, dollar)
+        except ParameterExpansionParseError:
+            if not envsubst:
+                raise
+            node, end = None, dollar + 1
+        if node is not None:
+            node = _dialect_node(node, dialect, operators)
+            if node is None:
+                if not envsubst:
+                    error = _DIALECT_ERRORS[dialect]
+                    raise ParameterExpansionParseError(error, s[dollar:end])
+                # text after this dollar sign may have expansions
+                end = dollar + 1
+        if node is None:
+            literal.append(s[dollar:end])
+            pos = end
+            continue
+        if literal_start < dollar:
+            parts.append("".join(literal))
+            if spans is not None:
+                spans.append((literal_start, dollar))
+        literal = []
+        parts.append(node)
+        if spans is not None:
+            spans.append((dollar, end))
+        pos = literal_start = end
+    if literal_start < len(s):
+        literal.append(s[pos:])
+        parts.append("".join(literal))
+        if spans is not None:
+            spans.append((literal_start, len(s)))
+    return tuple(parts)
+
+
+def _dialect_node(node: Any, dialect: str, operators: Any) -> Any:
+    """Return a node converted to a dialect or None if the dialect does not
+    support it.
+    """
+    kind = node[0]
+    special = dialect != "posix" and _special_name(node[1])
+    if kind == "$":
+        return None if special else ("{", node[1], None, "", (), None)
+    if kind == "{":
+        _, name, index, op, word, extra = node
+        if name.__class__ is not str or index is not None or op not in operators:
+            return None
+        if special:
+            return None
+        word = _dialect_parts(word, dialect, operators)
+        if word is None:
+            return None
+        return ("{", name, None, op, word, extra)
+    if kind == "q":
+        quoted = _dialect_node(node[1], dialect, operators)
+        return None if quoted is None else ("q", quoted)
+    if dialect == "posix":
+        if kind == "#" and node[1].__class__ is str and node[2] is None:
+            return node
+        if kind == "((":
+            expression = _dialect_parts(node[1], dialect, operators)
+            return None if expression is None else ("((", expression)
+    return None
+
+
+def _dialect_parts(parts: Parts, dialect: str, operators: Any) -> Optional[Parts]:
+    """Return a tuple of parts converted to a dialect or None if the dialect
+    does not support one of them.
+    """
+    converted = []
+    for part in parts:
+        if part.__class__ is not str:
+            part = _dialect_node(part, dialect, operators)
+            if part is None:
+                return None
+        converted.append(part)
+    return tuple(converted)
+
+
+# The values of the special parameters computed from an argv vector of $0
+# followed by the positional parameters, by name.
+_SPECIAL_PARAMETERS: Dict[str, Callable[[Sequence[str]], Any]] = {
+    "#": lambda argv: str(max(len(argv) - 1, 0)),
+    "@": lambda argv: list(argv[1:]),
+    "*": lambda argv: list(argv[1:]),
+    "?": lambda argv: "0",
+    "$": lambda argv: str(os.getpid()),
+}
+
+
+def _special_name(name: Any) -> bool:
+    """Return True if name is the name of a positional or special parameter."""
+    return name.__class__ is str and (
+        _match_number(name) is not None or name in _SPECIAL_PARAMETERS
+    )
+
+
+def _special_parameter(name: str, argv: Sequence[str]) -> Any:
+    """Return the value of the positional or special parameter name from the
+    argv vector of $0 followed by the positional parameters: None if unset or
+    if name is not such a parameter, a string or a list of strings for $@ and
+    $*. No command is ever run and $? is always 0.
+    """
+    if _match_number(name):
+        number = int(name)
+        return argv[number] if number < len(argv) else None
+    special = _SPECIAL_PARAMETERS.get(name)
+    if special is None:
+        return None
+    return special(argv)
+
+
+def _compile_pattern(pattern: str) -> Callable[..., Any]:
+    """Return a function matching a whole string with the pattern."""
+    return re.compile(translate(pattern)).match
+
+
+def _remove_affix(
+    subst: str, match: Callable[..., Any], suffix: bool, largest: bool
+) -> str:
+    """Return subst without its smallest or largest prefix or suffix matched
+    by the compiled pattern match.
+    """
+    indices = range(0, len(subst) + 1)
+    if largest != suffix:
+        indices = range(len(subst), -1, -1)
+    if suffix:
+        for i in indices:
+            if match(subst, i):
+                return subst[:i]
+        return subst
+    else:
+        for i in indices:
+            if match(subst[:i]):
+                return subst[i:]
+        return subst
+
+
+def _expand_simple(
+    code: Parts, env: Mapping[str, Any], argv: Sequence[str] = ()
+) -> Optional[str]:
+    """Return template code made only of literals and of $name and ${name}
+    expansions expanded with env and argv, or None if a parameter is unset or
+    is not a string.
+    """
+    expanded: List[str] = []
+    for part in code:
+        if part.__class__ is not str:
+            # the name of a $name or ${name} expansion
+            name = part[1]
+            part = env.get(name)
+            if part is None:
+                part = _special_parameter(name, argv)
+            if part.__class__ is not str:
+                return None
+        expanded.append(part)
+    return "".join(expanded)
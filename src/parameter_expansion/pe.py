@@ -9,6 +9,20 @@ as in `${foo:-${bar:-$baz}}` should work fine.
 Also support some level of Bash extensions to expansion [3]:
 - pattern substitution with `${foo/bar/baz}` (but only plain strings and not patterns)
 - substring expansion with `${foo:4:2}
+- indexed and associative arrays with `${foo[1]}`, `${foo[@]}`, `${#foo[@]}`
+  and `${!foo[@]}`, where an indexed array is a list and an associative array
+  is a dict in the environment
+- indirect expansion with `${!foo}` and names listing with `${!prefix*}`
+- arithmetic expansion with `$((MINOR + 1))`
+- positional and special parameters with `$1`, `${10}`, `$#`, `$@`, `$*`,
+  `$?` and `$$` from an argv list, and `~` and `~user` tilde prefixes
+- case modification with `${foo^}`, `${foo^^}`, `${foo,}` and `${foo,,}` and
+  transformations with `${foo@U}`, `${foo@u}`, `${foo@L}`, `${foo@Q}` and
+  `${foo@E}`
+
+Strings are parsed once into a `Template` (see `compile()`) that is then
+evaluated against an environment. Parsed templates are cached and can be saved
+to and loaded from a file with `dump_templates()` and `load_templates()`.
 
 
 ## Limitations
@@ -16,10 +30,16 @@ Also support some level of Bash extensions to expansion [3]:
 (Pull requests to remove limitations are welcome.)
 
 - Only ASCII alphanumeric characters and underscores are supported in parameter
-names. (Per POSIX, parameter names may not begin with a numeral.)
+names. (Per POSIX, parameter names may not begin with a numeral: names made of
+digits are positional parameters.) The special parameters are limited to `$#`,
+`$@`, `$*`, `$?` (always 0) and `$$`.
 
 - Assignment expansions do not mutate the real environment.
 
+- Indexed arrays are lists and are not sparse: assigning an element past the
+end of an array fills the gap with empty strings, which `${#foo[@]}` and
+`${!foo[@]}` then count, unlike in Bash.
+
 - For simplicity's sake, this implementation uses fnmatch instead of
 completely reimplementing [POSIX pattern matching][2]
 
@@ -30,12 +50,17 @@ completely reimplementing [POSIX pattern matching][2]
 [3]: https://www.gnu.org/software/bash/manual/html_node/Shell-Parameter-Expansion.html
 """
 
+import importlib.util
 import logging
+import marshal
+import mmap
 import os
 import re
 import sys
-from fnmatch import fnmatchcase
-from itertools import groupby, takewhile
+from bisect import bisect_left, insort
+from collections import namedtuple
+from functools import lru_cache
+from itertools import groupby
 from shlex import shlex
 
 # Tracing flags: set to True to enable debug trace
@@ -52,71 +77,876 @@ def logger_debug(*args):
     logger.debug(" ".join(a if isinstance(a, str) else repr(a) for a in args))
 
 
-def expand(s, env=None, strict=False):
+def expand(s, env=None, strict=False, dialect="bash", argv=None):
     """Expand the string using POSIX parameter expansion rules.
     Uses the provided environment dict or the actual environment.
     If strict is True, raise a ParameterExpansionNullError on missing
     env variable.
 
+    argv is a list of $0 followed by the positional parameters $1, $2, etc.
+    such as ``sys.argv``. Without argv, there are no positional parameters.
+
+    dialect is one of "bash" for the POSIX rules with Bash extensions,
+    "posix", "compose" for docker-compose files or "envsubst" (see
+    ``compile()``).
+
     For example::
     >>> env = {"foo": "bar", "foobar": "BAR"}
     >>> expand("${foo${foo}}", env=env, strict=True)
     'BAR'
+    >>> expand("$$foo ${foo:?is not set}", env=env, dialect="compose")
+    '$foo bar'
+    >>> expand("$# ${2}-$1 ${@:2}", argv=["script", "a", "b", "c"])
+    '3 b-a b c'
     """
-    if env is None:
-        env = dict(os.environ)
+    if "$" not in s and not s.startswith("~"):
+        if dialect != "bash" and dialect not in _DIALECT_OPERATORS:
+            raise ValueError(f"Unknown dialect: {dialect!r}")
+        if _count_stats:
+            _stats["literal"] += 1
+        return s
+    return compile(s, dialect).expand(env=env, strict=strict, argv=argv)
+
+
+def expansion_stats(reset=False, enable=None):
+    """Return a dict of the number of expansions by path: "literal" for
+    strings without expansions, "simple" for strings with only $name and
+    ${name} expansions of set parameters and "general" for the others.
+    Expansions are only counted once enabled with enable=True, and no longer
+    with enable=False. Counts are approximate when expanding from several
+    threads. If reset is True, reset the counts to zero.
 
-    # Loop until fully expanded or no longer expanding anything
-    #  - expand simple parameters (i.e. these without a shell expression)
-    #  - get plain expressions and expand them (i.e. non-nested expressions)
-    # Eventually all complex expressions are composed of simple expressions and
-    # will be expanded this way.
+    For example::
+    >>> _ = expansion_stats(reset=True, enable=True)
+    >>> expand("$foo/bar", env={"foo": "x"}), expand("foo"), expand("${foo:-x}")
+    ('x/bar', 'foo', 'x')
+    >>> expansion_stats(reset=True, enable=False)
+    {'literal': 1, 'simple': 1, 'general': 1}
+    """
+    global _count_stats
+    stats = dict(_stats)
+    if reset:
+        for kind in _stats:
+            _stats[kind] = 0
+    if enable is not None:
+        _count_stats = bool(enable)
+    return stats
+
+
+def validate(s, env=None, argv=None):
+    """Return a list of all the problems found expanding the string s in
+    strict mode with the provided environment dict or the actual environment
+    and the optional argv list of $0 followed by the positional parameters,
+    as ``Problem`` tuples. env is not updated.
+
+    For example::
+    >>> for problem in validate("${a}/${b:?unset}/${c@}", env={}):
+    ...     print(problem)
+    Problem(kind='unset', name='a', start=0, end=4, message='parameter not set')
+    Problem(kind='unset', name='b', start=5, end=16, message='unset')
+    Problem(kind='parse', name=None, start=17, end=22, message='Bad substitution: ${c@')
+    """
+    problems = []
+    env = os.environ if env is None else env
+    evaluator = _Evaluator(env, True, True, argv=() if argv is None else argv)
+    found = evaluator.problems = []
+    pos = 0
+    find = s.find
     while True:
-        # use this to track if we are expanding in this cycle
-        original_s = s
-        s = expand_simple(s, env)
+        dollar = find("$", pos)
+        if dollar < 0:
+            break
+        try:
+            node, end = _parse_dollar(s, dollar)
+        except ParameterExpansionParseError as e:
+            # skip to the end of the bad expansion
+            end = find("}", dollar) + 1 or len(s)
+            problems.append(Problem("parse", None, dollar, end, _message(e)))
+            pos = end
+            continue
+        if node is not None:
+            try:
+                evaluator.compute(node)
+            except ParameterExpansionParseError as e:
+                found.append(("parse", None, _message(e)))
+            for kind, name, message in found:
+                problems.append(Problem(kind, name, dollar, end, message))
+            found.clear()
+        pos = end
+    return problems
+
+
+def _message(error):
+    return ": ".join(map(str, error.args))
+
+
+def expand_with_spans(s, env=None, strict=False, argv=None):
+    """Expand the string like ``expand()`` and return a tuple of (expanded,
+    spans) where spans is a list of (start, end, out_start, out_end) tuples
+    that map each literal or expansion at s[start:end] to the text it produced
+    at expanded[out_start:out_end].
 
-        plain_exps = get_plain_expressions(s)
+    For example::
+    >>> expand_with_spans("${foo%.*}-$bar", env={"foo": "a.b", "bar": "c"})
+    ('a-c', [(0, 9, 0, 1), (9, 10, 1, 2), (10, 14, 2, 3)])
+    """
+    return compile(s).expand_with_spans(env=env, strict=strict, argv=argv)
 
-        if not plain_exps:
-            break
 
-        for plain in plain_exps:
+def expand_column(template, columns, env=None, strict=False, argv=None):
+    """Expand a template string or ``Template`` once for each row of columns
+    and return the list of expanded strings. See ``Template.expand_column()``.
 
-            expanded = "".join(expand_tokens(plain, env=env, strict=strict))
-            logger_debug("expand: plain:", plain, "expanded:", expanded)
-            s = s.replace(plain, expanded)
-            s = expand_simple(s, env)
+    For example::
+    >>> columns = {"name": ["foo", "bar"], "version": ["1.0", ""]}
+    >>> expand_column("$name-${version:-0}", columns)
+    ['foo-1.0', 'bar-0']
+    """
+    if not isinstance(template, Template):
+        template = compile(template)
+    return template.expand_column(columns, env=env, strict=strict, argv=argv)
 
-        # check if we expanded or not in this cycle and exit
-        has_expanded = s != original_s
-        if not has_expanded:
-            break
 
-    logger_debug("expand: final", s)
-    return s
+def _import_core(backend):
+    """Return a tuple of (backend, module) for the _core module of the
+    requested backend: "compiled", "python" or "" for the compiled module if
+    it is installed and the pure Python module otherwise.
+    """
+    if backend not in ("", "compiled", "python"):
+        raise ImportError(f"Unknown parameter_expansion backend: {backend!r}")
+    if backend != "python":
+        from . import _core
+
+        if not _core.__file__.endswith(".py"):
+            return "compiled", _core
+        if backend == "compiled":
+            raise ImportError("The compiled parameter_expansion._core is not installed")
+        return "python", _core
+    # load the source module even if a compiled module is installed
+    name = __package__ + "._core"
+    path = os.path.join(os.path.dirname(__file__), "_core.py")
+    spec = importlib.util.spec_from_file_location(name, path)
+    core = importlib.util.module_from_spec(spec)
+    sys.modules[name] = core
+    spec.loader.exec_module(core)
+    return "python", core
+
+
+# The parser, pattern matching and simple expansions are in the _core module
+# that may be compiled with mypyc (see setup.py). BACKEND is "compiled" if it
+# is and "python" otherwise. Set the PARAMETER_EXPANSION_BACKEND environment
+# variable to "python" to use the pure Python module even if a compiled one is
+# installed, or to "compiled" to fail on import if none is.
+BACKEND, _core = _import_core(os.environ.get("PARAMETER_EXPANSION_BACKEND", ""))
+
+ParameterExpansionNullError = _core.ParameterExpansionNullError
+ParameterExpansionParseError = _core.ParameterExpansionParseError
+_parse = _core._parse
+_parse_dialect = _core._parse_dialect
+_parse_dollar = _core._parse_dollar
+_parse_tilde = _core._parse_tilde
+_parse_word = _core._parse_word
+_glob_escape = _core._glob_escape
+_compile_pattern = _core._compile_pattern
+_remove_affix = _core._remove_affix
+_expand_simple = _core._expand_simple
+_special_name = _core._special_name
+_special_parameter = _core._special_parameter
+_match_number = _core._match_number
+_DIALECT_OPERATORS = _core._DIALECT_OPERATORS
+
+
+class Problem(namedtuple("Problem", ["kind", "name", "start", "end", "message"])):
+    """A problem found by ``validate()`` in the expansion at s[start:end] of
+    the parameter name. kind is "unset" for an unset parameter, "null" for a
+    ${name:?message} expansion of a null parameter or "parse" for a parse
+    error, whose name is None.
+    """
+
+    __slots__ = ()
+
+
+class Template:
+    """A shell string parsed once and ready to be expanded against any number
+    of environments.
+
+    ``code`` is a tuple of parts: either literal strings or expansion nodes.
+    Nodes are plain nested tuples of strings so that they can be serialized
+    with ``marshal`` (see ``dump_templates()``).
+
+    For example::
+    >>> template = compile("${name%.*}-$version")
+    >>> template.expand({"name": "foo.tar", "version": "1.0"})
+    'foo-1.0'
+    """
+
+    __slots__ = ("source", "code", "dialect", "kind", "repeated", "spans")
+
+    def __init__(self, source, code, dialect="bash"):
+        self.source = source
+        self.code = code
+        self.dialect = dialect
+        # "literal", "simple" or "general", see expansion_stats()
+        self.kind = _classify(code)
+        # the nodes that occur more than once, whose results are memoized
+        # for the duration of an expansion, or None
+        self.repeated = _repeated_nodes(code)
+        # the (start, end) source spans of each part of code, computed on
+        # demand
+        self.spans = None
+
+    def __repr__(self):
+        return f"Template({self.source!r})"
+
+    def expand(self, env=None, strict=False, argv=None):
+        """Return this template expanded using the provided environment dict
+        or the actual environment and the optional argv list of $0 followed by
+        the positional parameters. Assignment expansions such as
+        ``${foo:=bar}`` update ``env``.
+        """
+        argv = () if argv is None else argv
+        expanded = _expand_fast(self, os.environ if env is None else env, argv)
+        if expanded is None:
+            if env is None:
+                env = dict(os.environ)
+            expanded = _Evaluator(env, strict, argv=argv).expand(self)
+        if TRACE:
+            logger_debug("expand:", self.source, "expanded:", expanded)
+        return expanded
+
+    def expand_values(self, name, values, env=None, strict=False, argv=None):
+        """Return a list of this template expanded once for each value in
+        ``values`` of the parameter ``name``, using the provided environment
+        dict or the actual environment for other parameters and the optional
+        argv list of $0 followed by the positional parameters. A None value
+        is an unset parameter. Assignment expansions only apply to the
+        expansion of their own value and do not update ``env``.
+
+        For example::
+        >>> compile("${PN^^}").expand_values("PN", ["foo", "bar"])
+        ['FOO', 'BAR']
+        """
+        transform = _value_transform(self.code, name)
+        if transform is not None:
+            expanded = [None if value is None else transform(value) for value in values]
+            if None in expanded:
+                if strict:
+                    raise ParameterExpansionNullError(name)
+                expanded = ["" if value is None else value for value in expanded]
+            return expanded
+
+        env = dict(os.environ if env is None else env)
+        evaluator = _Evaluator(env, strict, argv=() if argv is None else argv)
+        expand = evaluator.expand
+        expanded = []
+        for value in values:
+            if value is None:
+                env.pop(name, None)
+            else:
+                env[name] = value
+            # assignments only apply to their own value
+            evaluator.env = env
+            evaluator.copy_on_write = True
+            evaluator.names = evaluator.copied = None
+            expanded.append(expand(self))
+        return expanded
+
+    def expand_column(self, columns, env=None, strict=False, argv=None):
+        """Return a list of this template expanded once for each row of the
+        ``columns`` mapping of parameter names to equal length sequences of
+        values, using the provided environment dict or the actual environment
+        for other parameters and the optional argv list of $0 followed by the
+        positional parameters. A None value is an unset parameter, as are NaN
+        and the missing values of pandas Series. Other values must be strings.
+
+        Expansions of a column whose words are literals, such as
+        ``${name%.*}`` or ``${version:-0}``, are computed column-wise.
+        Templates with other expansions of columns, such as assignments or
+        nested expansions, are expanded row by row. If all the columns are
+        NumPy string arrays and the template only has plain, default and
+        alternate expansions, the columns are concatenated with NumPy and a
+        NumPy array is returned.
+        """
+        sizes = {len(values) for values in columns.values()}
+        if len(sizes) > 1:
+            raise ValueError("columns must have the same length")
+        size = sizes.pop() if sizes else 0
+        argv = () if argv is None else argv
+        env = dict(os.environ if env is None else env)
+        for name in columns:
+            env.pop(name, None)
+
+        numpy, columns = _numpy_columns(columns)
+        if numpy is None:
+            columns = {name: _column_list(name, v) for name, v in columns.items()}
+        parts = _column_parts(self.code, columns, numpy is not None)
+        if parts is None and numpy is not None:
+            columns = {name: values.tolist() for name, values in columns.items()}
+            parts = _column_parts(self.code, columns, False)
+            numpy = None
+        if parts is not None and strict and numpy is None:
+            # only the evaluator raises for unset parameters
+            for part in parts:
+                if part[0] == "c" and part[2] not in _DEFAULT_OPERATORS:
+                    if None in columns[part[1]]:
+                        parts = None
+                        break
+
+        if parts is not None:
+            evaluator = _Evaluator(env, strict, argv=argv)
+            pieces = []
+            for part in parts:
+                if part.__class__ is str:
+                    pieces.append(part)
+                elif part[0] == "c":
+                    _, name, op, word, extra = part
+                    values = columns[name]
+                    if numpy is None:
+                        values = _column_values(
+                            evaluator, values, name, op, word, extra
+                        )
+                    else:
+                        values = _numpy_column_values(numpy, values, op, "".join(word))
+                    pieces.append(values)
+                else:
+                    # an expansion of the env that is the same for every row
+                    pieces.append(evaluator.compute(part))
+            if numpy is None:
+                return _concatenate_columns(pieces, size)
+            return _numpy_concatenate(numpy, pieces, size)
+
+        names = list(columns)
+        evaluator = _Evaluator(env, strict, argv=argv)
+        expand = evaluator.expand
+        expanded = []
+        for row in zip(*columns.values()):
+            for name, value in zip(names, row):
+                if value is None:
+                    env.pop(name, None)
+                else:
+                    env[name] = value
+            # assignments only apply to their own row
+            evaluator.env = env
+            evaluator.copy_on_write = True
+            evaluator.names = evaluator.copied = None
+            expanded.append(expand(self))
+        return expanded
+
+    def expand_with_spans(self, env=None, strict=False, argv=None):
+        """Return a tuple of (expanded, spans) for this template expanded
+        using the provided environment dict or the actual environment and the
+        optional argv list of $0 followed by the positional parameters. See
+        ``expand_with_spans()``.
+        """
+        if env is None:
+            env = dict(os.environ)
+        spans = self.spans
+        if spans is None:
+            spans = []
+            _parse_dialect(self.source, self.dialect, spans)
+            spans = self.spans = tuple(spans)
+        evaluator = _Evaluator(env, strict, argv=() if argv is None else argv)
+        return evaluator.expand_with_spans(self, spans)
+
+
+# Maximum number of templates compiled on the fly that are kept in the cache.
+_MAXCACHE = 4096
+_cache = {}  # type: dict
+
+# Template code loaded with load_templates(), by source string.
+_loaded = {}  # type: dict
+
+
+def compile(s, dialect="bash"):
+    """Return a ``Template`` for the shell string ``s``.
+    Templates are cached by source string and dialect.
+
+    The dialect selects the expansions that are supported and is one of:
+
+    - "bash": the POSIX rules with Bash extensions, the default.
+    - "posix": the POSIX operators only. $name is the whole name.
+    - "compose": the docker-compose interpolation: $name, ${name} and the
+      -, :-, ?, :?, + and :+ operators. $$ is a literal dollar sign outside
+      of braces.
+    - "envsubst": $name and ${name} only. Other text is kept as is.
+
+    Unset parameters of $name expansions are empty in all dialects but bash.
+    Other expansions raise a ParameterExpansionParseError in the posix and
+    compose dialects.
+    """
+    key = s if dialect == "bash" else (dialect, s)
+    template = _cache.get(key)
+    if template is not None:
+        return template
+    if dialect == "bash":
+        code = _loaded.get(s)
+        if code is None:
+            code = _parse(s)
+    else:
+        code = _parse_dialect(s, dialect)
+    if len(_cache) >= _MAXCACHE:
+        _cache.clear()
+    template = _cache[key] = Template(s, code, dialect)
+    return template
+
 
+class Expander:
+    """Expand strings with a configuration and caches of templates, patterns
+    and arithmetic expressions of its own. An Expander can be shared by
+    threads: reading its caches takes no lock and expansions never update an
+    env. Assignment expansions such as
+    ``${foo:=bar}`` apply for the rest of an expansion only, using a copy of
+    the env that is made on the first assignment.
 
-class ParameterExpansionNullError(LookupError):
-    pass
+    Uses the provided environment dict or a copy of the actual environment
+    made when the Expander is created, and the optional argv list of $0
+    followed by the positional parameters.
 
+    For example::
+    >>> expander = Expander(env={"foo": "bar"}, strict=True)
+    >>> expander.expand("${baz:=$foo}/$baz")
+    'bar/bar'
+    >>> expander.env
+    {'foo': 'bar'}
+    """
+
+    def __init__(
+        self,
+        env=None,
+        strict=False,
+        trace=False,
+        maxcache=_MAXCACHE,
+        dialect="bash",
+        argv=None,
+    ):
+        self.env = dict(os.environ) if env is None else env
+        self.argv = () if argv is None else argv
+        self.strict = strict
+        self.trace = trace
+        self.maxcache = maxcache
+        self.dialect = dialect
+        self._templates = {}
+        self._caches = _Caches(maxcache)
+
+    def compile(self, s):
+        """Return a ``Template`` for the shell string ``s`` in the dialect of
+        this Expander.
+        """
+        template = self._templates.get(s)
+        if template is None:
+            dialect = self.dialect
+            if dialect == "bash":
+                code = _loaded.get(s)
+                if code is None:
+                    code = _parse(s)
+            else:
+                code = _parse_dialect(s, dialect)
+            templates = self._templates
+            if len(templates) >= self.maxcache:
+                # replace rather than clear the cache that other threads may
+                # be reading
+                templates = self._templates = {}
+            template = templates[s] = Template(s, code, dialect)
+        return template
+
+    def expand(self, s, env=None):
+        """Return the string s expanded using the provided environment dict
+        or the env of this Expander. env is not updated.
+        """
+        template = self.compile(s)
+        if env is None:
+            env = self.env
+        argv = self.argv
+        expanded = _expand_fast(template, env, argv)
+        if expanded is None:
+            evaluator = _Evaluator(
+                env, self.strict, copy_on_write=True, argv=argv, caches=self._caches
+            )
+            expanded = evaluator.expand(template)
+        if self.trace:
+            logger_debug("expand:", s, "expanded:", expanded)
+        return expanded
 
-class ParameterExpansionParseError(Exception):
-    pass
 
+def freeze(env=None):
+    """Return a ``FrozenEnv`` copy of the provided environment dict or of the
+    actual environment, to expand many strings with.
 
-def expand_tokens(s, env, strict=False):
-    tokens = tokenize(s)
+    For example::
+    >>> env = freeze({"foo": "bar"})
+    >>> expand("${foo}/$foobar", env=env)
+    'bar/barbar'
+    >>> expand("${baz:=qux}", env=env)
+    Traceback (most recent call last):
+    ...
+    TypeError: FrozenEnv does not support assignment
+    """
+    if isinstance(env, FrozenEnv):
+        return env
+    return FrozenEnv(os.environ if env is None else env)
+
+
+class FrozenEnv(dict):
+    """A read-only environment dict whose names are interned and indexed
+    once, created with ``freeze()``. ``names`` is the sorted list of names for
+    ${!prefix*} expansions and a prefix trie finds the longest name that
+    starts an unset $word.
+
+    Assignment expansions such as ``${foo:=bar}`` raise a TypeError unless
+    the FrozenEnv is the env of an ``Expander``, whose assignments go to a
+    copy of it.
+    """
+
+    __slots__ = ("names", "trie")
+
+    def __init__(self, env=()):
+        intern = sys.intern
+        super().__init__((intern(name), value) for name, value in dict(env).items())
+        self.names = sorted(self)
+        trie = self.trie = {}
+        for name in self.names:
+            node = trie
+            for char in name:
+                node = node.setdefault(char, {})
+            # the empty key marks the end of a name
+            node[""] = name
+
+    def __repr__(self):
+        return f"FrozenEnv({dict.__repr__(self)})"
+
+    def __reduce__(self):
+        # rebuild copies and unpickled envs without __setitem__
+        return FrozenEnv, (dict(self),)
+
+    def longest_name(self, word):
+        """Return the longest name that starts word or None."""
+        node = self.trie
+        found = None
+        for char in word:
+            node = node.get(char)
+            if node is None:
+                break
+            found = node.get("", found)
+        return found
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("FrozenEnv does not support assignment")
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+
+# The cache file starts with a magic string and the version of the template
+# code layout, followed by a marshalled {source: code} dict.
+_CACHE_MAGIC = b"PXTC"
+_CACHE_VERSION = 3
+_CACHE_HEADER = _CACHE_MAGIC + _CACHE_VERSION.to_bytes(2, "little")
+
+
+def dump_templates(path, templates):
+    """Save the compiled code of ``templates`` to the file at ``path``.
+    ``templates`` is an iterable of ``Template`` objects or of source strings.
+    """
+    codes = {}
+    for template in templates:
+        if isinstance(template, str):
+            template = compile(template)
+        elif template.dialect != "bash":
+            raise ValueError(f"Only bash templates can be saved: {template!r}")
+        codes[template.source] = template.code
+    with open(path, "wb") as out:
+        out.write(_CACHE_HEADER)
+        marshal.dump(codes, out)
+
+
+def load_templates(path):
+    """Load the templates saved with ``dump_templates()`` in the file at
+    ``path`` so that ``compile()`` and ``expand()`` do not parse them again.
+    All the templates of the file are read at once. Return the number of
+    templates loaded. A file saved with an older cache version is ignored and
+    0 is returned.
+    """
+    with open(path, "rb") as inp:
+        header = inp.read(len(_CACHE_HEADER))
+        if not header.startswith(_CACHE_MAGIC):
+            raise ValueError(f"Not a template cache file: {path!r}")
+        if header != _CACHE_HEADER:
+            return 0
+        codes = marshal.load(inp)
+    _loaded.update(codes)
+    return len(codes)
+
+
+_match_assignment = re.compile(
+    r"\s*(?:(?:export|readonly|local|declare)\s+)?([A-Za-z_]\w*)=",
+    re.ASCII,
+).match
+
+
+# split the words of an array assignment on unquoted whitespace
+_split_words = re.compile(r"""(?:[^\s'"\\]|\\.|'[^']*'|"(?:[^"\\]|\\.)*")+""").findall
+
+# match the (words) of an array assignment up to its unquoted closing paren
+_match_array = re.compile(
+    r"""\(((?:[^)'"\\]|\\.|'[^']*'|"(?:[^"\\]|\\.)*")*)\)"""
+).match
+
+_VALUE_STOPS = _core._VALUE_STOPS
+
+
+@lru_cache(maxsize=_MAXCACHE)
+def _compile_value(value):
+    """Return a tuple of (parts, end) for the template parts of the value of an
+    assignment at the start of value, which ends at index end at the first
+    unquoted blank or control operator. parts is None if a quote or an
+    expansion is not terminated.
+    """
+    # a newline ends the last value as lines have none
+    parts, end = _parse_word(value + "\n", 0, _VALUE_STOPS)
+    if parts is None:
+        return None, len(value)
+    tilde, start = _parse_tilde(value[:end])
+    if tilde is not None:
+        parts, _ = _parse_word(value[:end] + "\n", start, _VALUE_STOPS)
+        parts = (tilde,) + parts
+    return parts, end
+
+
+# match a quoted string or escaped character, or a comment
+_sub_comment = re.compile(r"""(\\.|'[^']*'|"(?:[^"\\]|\\.)*")|(?<!\S)#.*""").sub
+
+
+def _strip_comment(line):
+    """Return a line of the words of an array without its comment."""
+    return _sub_comment(lambda match: match.group(1) or "", line)
+
+
+def _expand_rest(evaluator, rest):
+    """Return the rest of an assignment line after its value: unchanged if it
+    is a comment, expanded otherwise.
+    """
+    if not rest.strip() or rest.lstrip().startswith("#"):
+        return rest
+    return evaluator.expand(compile(rest))
+
+
+def expand_script(text, env=None, strict=False, argv=None):
+    """Expand a shell script text line by line in a single pass and return a
+    tuple of (env, lines) with the final env and the list of expanded lines.
+    Uses a copy of the provided environment dict or of the actual environment
+    and the optional argv list of $0 followed by the script arguments.
+
+    Lines with a simple ``NAME=value`` assignment (optionally prefixed with
+    export, readonly, local or declare) update the env with their expanded
+    value, as do ``${NAME:=value}`` assignment expansions, so that each line
+    is expanded with the assignments of the lines before it. ``NAME=(a b c)``
+    assigns an indexed array, whose words may span several lines: the
+    assignment is then returned as a single line. As in the shell, a value
+    ends at the first unquoted blank or control operator such as ``;``: the
+    rest of the line is expanded, or returned unchanged if it is a comment,
+    as are comment lines.
+
+    For example::
+    >>> env, lines = expand_script("pkgver=1.2\\ndir=${pkgname:=foo}-$pkgver")
+    >>> env["dir"], env["pkgname"]
+    ('foo-1.2', 'foo')
+    >>> lines
+    ['pkgver=1.2', 'dir=foo-1.2']
+    """
+    env = dict(os.environ if env is None else env)
+    evaluator = _Evaluator(env, strict, argv=() if argv is None else argv)
+    source = text.splitlines()
+    index = 0
+    lines = []
+    while index < len(source):
+        line = source[index]
+        index += 1
+        assignment = _match_assignment(line)
+        if assignment and line.startswith("(", assignment.end()):
+            start = assignment.end()
+            value = line[start:]
+            following = index
+            array = _match_array(value)
+            if not array:
+                # the words of an array may span several lines
+                value = _strip_comment(value)
+                while not array and following < len(source):
+                    value += "\n" + _strip_comment(source[following])
+                    following += 1
+                    array = _match_array(value)
+            if array:
+                words = _split_words(array.group(1))
+                values = [_compile_value(word) for word in words]
+                if all(end == len(word) for word, (_, end) in zip(words, values)):
+                    index = following
+                    expanded = [evaluator.evaluate(parts) for parts, _ in values]
+                    evaluator.assign(assignment.group(1), None, expanded)
+                    rest = _expand_rest(evaluator, value[array.end() :])
+                    lines.append(line[:start] + f"({' '.join(expanded)})" + rest)
+                    continue
+        elif assignment:
+            start = assignment.end()
+            value = line[start:]
+            parts, end = _compile_value(value)
+            if parts is not None:
+                value, rest = evaluator.evaluate(parts), value[end:]
+                evaluator.assign(assignment.group(1), None, value)
+                lines.append(line[:start] + value + _expand_rest(evaluator, rest))
+                continue
+        if line.lstrip().startswith("#"):
+            lines.append(line)
+        else:
+            lines.append(evaluator.expand(compile(line)))
+    return env, lines
+
+
+# expand_file() expands the rest of a line at once if it is shorter than
+# _LINEREGION bytes and its expansions are terminated, keeping the templates of
+# up to _MAXLINES lines. Other expansions are parsed one by one from a window
+# of _MINREGION bytes, doubled up to _MAXREGION until the expansion ends.
+_LINEREGION = 4096
+_MAXLINES = 1024
+_MINREGION = 256
+_MAXREGION = 1 << 20
+
+
+def expand_file(src_path, dst_path, env=None, strict=False, dialect="bash", argv=None):
+    """Expand the UTF-8 text file at ``src_path`` into the file at
+    ``dst_path``. Uses the provided environment dict or the actual
+    environment, which assignment expansions update as for ``expand()``, and
+    the optional argv list of $0 followed by the positional parameters.
+
+    The input file is memory-mapped and the bytes between expansions are
+    written as is. Only the text of each expansion is decoded and parsed, so
+    memory use does not depend on the size of the file or of its lines.
+    Expansions longer than 1 MiB are kept as is. Templates are cached for the
+    duration of the expansion only.
+    """
+    if os.path.exists(dst_path) and os.path.samefile(src_path, dst_path):
+        raise ValueError(f"Cannot expand a file in place: {src_path!r}")
+    if env is None:
+        env = dict(os.environ)
+    argv = () if argv is None else argv
+    evaluator = _Evaluator(env, strict, argv=argv)
+    # templates by line bytes and by expansion text, kept apart from the
+    # cache of compile()
+    templates = {}
+    with open(src_path, "rb") as inp, open(dst_path, "wb") as out:
+        size = os.fstat(inp.fileno()).st_size
+        if not size:
+            return
+        with mmap.mmap(inp.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(mapped) as view:
+                find = mapped.find
+                write = out.write
+                # the bytes up to pos are written and dollar signs are
+                # searched from scan
+                pos = scan = 0
+                while True:
+                    dollar = find(b"$", scan)
+                    if dollar < 0:
+                        write(view[pos:])
+                        break
+                    template, scan = _compile_region(
+                        mapped, dollar, size, dialect, templates
+                    )
+                    if template is None:
+                        continue
+                    if pos < dollar:
+                        write(view[pos:dollar])
+                    pos = scan
+                    expanded = _expand_fast(template, env, argv)
+                    if expanded is None:
+                        expanded = evaluator.expand(template)
+                    write(expanded.encode("utf-8", "surrogateescape"))
+
+
+def _compile_region(mapped, start, size, dialect, templates):
+    """Return a tuple of (template, end) for the region of the mapped file to
+    expand at once from the dollar sign at index start: the rest of a short
+    line or else the expansion at start. template is None if this dollar sign
+    is a literal.
+    """
+    end = mapped.find(b"\n", start, start + _LINEREGION) + 1
+    if not end and size - start <= _LINEREGION:
+        end = size
+    if end:
+        line = mapped[start:end]
+        template = templates.get(line)
+        if template is not None:
+            return template, end
+        s = str(line, "utf-8", "surrogateescape")
+        template = Template(s, _parse_dialect(s, dialect), dialect)
+        if not _unterminated(template):
+            if len(templates) >= _MAXLINES:
+                templates.clear()
+            templates[line] = template
+            return template, end
+    return _compile_expansion(mapped, start, size, dialect, templates)
+
+
+def _unterminated(template):
+    """Return True if a ${...} or $((...)) expansion of a template is not
+    terminated and was parsed as a literal.
+    """
+    literals = [part for part in template.code if part.__class__ is str]
+    if not any("${" in part or "$((" in part for part in literals):
+        return False
+    s = template.source
+    pos = s.find("$")
+    while pos >= 0:
+        try:
+            node, end = _parse_dollar(s, pos)
+        except ParameterExpansionParseError:
+            if template.dialect != "envsubst":
+                raise
+            # envsubst keeps bad expansions as is
+            pos = s.find("$", pos + 1)
+            continue
+        if node is None and s.startswith(("{", "(("), pos + 1):
+            return True
+        pos = s.find("$", end)
+    return False
+
+
+def _compile_expansion(mapped, start, size, dialect, templates):
+    """Return a tuple of (template, end) for the expansion at the dollar sign
+    at index start of the mapped file, or (None, start + 1) if this dollar sign
+    is a literal. Templates are cached in the templates dict.
+    """
+    length = _MINREGION
     while True:
+        end = min(start + length, size)
+        s = str(mapped[start:end], "utf-8", "surrogateescape")
+        truncated = end < size and length < _MAXREGION
         try:
-            before_dollar = "".join(takewhile(lambda t: t != "$", tokens))
-            logger_debug("expand_tokens: before_dollar:", repr(before_dollar))
-            yield before_dollar
-            sigil = follow_sigil(tokens, env, strict)
-            logger_debug("expand_tokens: sigil:", repr(sigil))
-            yield sigil
-        except StopIteration:
-            return
+            node, stop = _parse_dollar(s, 0)
+        except ParameterExpansionParseError:
+            if truncated:
+                length *= 2
+                continue
+            if dialect != "envsubst":
+                raise
+            return None, start + 1
+        if not truncated:
+            break
+        if node is None and not s.startswith(("${", "$((")):
+            return None, start + 1
+        if node is not None and stop < len(s):
+            break
+        # this expansion may end after the window
+        length *= 2
+    if node is None:
+        return None, start + 1
+    s = s[:stop]
+    template = templates.get(s)
+    if template is None:
+        if len(templates) >= _MAXLINES:
+            templates.clear()
+        template = templates[s] = Template(s, _parse_dialect(s, dialect), dialect)
+    return template, start + len(s.encode("utf-8", "surrogateescape"))
 
 
 def tokenize(s):
@@ -132,54 +962,1133 @@ def tokenize(s):
             yield from group
 
 
-_get_non_nested_expressions = re.compile(r"(\$\{[^${}]+\})").findall
+def is_whitespace(s):
+    return all(c in " \t\n" for c in s)
 
 
-def get_plain_expressions(s):
-    """Return a list of plain, non-nested shell expressions found in the shell
-    string s. These are shell expressions that do not further contain a nested
-    expression and can therefore be resolved indenpendently.
+#
+# Evaluation
+#
 
-    For example::
-    >>> get_plain_expressions("${_pyname%${_pyname#?}}")
-    ['${_pyname#?}']
-    """
-    return _get_non_nested_expressions(s)
-
-
-def follow_sigil(shl, env, strict=False):
-    param = next(shl)
-    if param == "{":
-        # note: we consume the iterator here on purpose
-        inside_sigils = list(takewhile(lambda t: t != "}", shl))
-        logger_debug("follow_sigil: inside_sigils:", inside_sigils)
-        # note: downstream code expects an iterator with a next() and not a list
-        inside_sigils = iter(inside_sigils)
-        return follow_brace(inside_sigils, env, strict)
-    expanded = env.get(param)
-    if strict and expanded is None:
-        raise ParameterExpansionNullError(param)
-    return expanded or ""
-
-
-def expand_simple(s, env):
-    """Expand a string containing shell variable substitutions.
-    This expands the forms $variable and ${variable} only.
-    Non-existent variables are left unchanged.
-    Uses the provided environment dict.
-    Similar to ``os.path.expandvars``.
-    """
-    env_by_decreasing_name_length = sorted(
-        env.items(),
-        # [0] is the name.  minus its length gets the longest first.
-        key=lambda name_value: -len(name_value[0]),
+
+# number of expansions by path when _count_stats is set, see expansion_stats()
+_stats = {"literal": 0, "simple": 0, "general": 0}
+_count_stats = False
+
+
+def _classify(code):
+    """Return "literal" if template code has no expansions, "simple" if it
+    only has $name and ${name} expansions or "general" otherwise.
+    """
+    kind = "literal"
+    for part in code:
+        if part.__class__ is str:
+            continue
+        if part[0] == "$" or (
+            part[0] == "{"
+            and part[1].__class__ is str
+            and part[2] is None
+            and not part[3]
+        ):
+            kind = "simple"
+        else:
+            return "general"
+    return kind
+
+
+def _expand_fast(template, env, argv=()):
+    """Return the expansion of a literal template or of a simple template
+    whose parameters are set to strings in env or argv, or None if the
+    template must be expanded by an _Evaluator.
+    """
+    kind = template.kind
+    if kind == "literal":
+        expanded = template.source
+    elif kind == "simple":
+        expanded = _expand_simple(template.code, env, argv)
+        if expanded is None:
+            kind = "general"
+    else:
+        expanded = None
+    if _count_stats:
+        _stats[kind] += 1
+    return expanded
+
+
+def _repeated_nodes(code):
+    """Return a frozenset of the nodes that occur more than once in the
+    template code or None.
+    """
+    counts = {}
+    stack = [code]
+    while stack:
+        for part in stack.pop():
+            if part.__class__ is str:
+                continue
+            counts[part] = counts.get(part, 0) + 1
+            if part[0] == "q":
+                stack.append(part[1:])
+                continue
+            stack.extend(child for child in part[1:] if child.__class__ is tuple)
+    repeated = frozenset(node for node, count in counts.items() if count > 1)
+    return repeated or None
+
+
+class _Caches:
+    """Caches of compiled patterns and arithmetic expressions by source
+    string. The module functions share one _Caches and each ``Expander`` has
+    its own.
+    """
+
+    __slots__ = ("maxcache", "matchers", "arithmetic")
+
+    def __init__(self, maxcache=_MAXCACHE):
+        self.maxcache = maxcache
+        self.matchers = {}
+        self.arithmetic = {}
+
+    def matcher(self, pattern):
+        """Return a function matching a whole string with the pattern."""
+        match = self.matchers.get(pattern)
+        if match is None:
+            match = _compile_pattern(pattern)
+            matchers = self.matchers
+            if len(matchers) >= self.maxcache:
+                # replace rather than clear a cache that other threads may be
+                # reading
+                matchers = self.matchers = {}
+            matchers[pattern] = match
+        return match
+
+    def arithmetic_function(self, expression):
+        """Return a function of an _Evaluator that evaluates the arithmetic
+        expression.
+        """
+        function = self.arithmetic.get(expression)
+        if function is None:
+            function = _ArithmeticParser(expression).compile()
+            functions = self.arithmetic
+            if len(functions) >= self.maxcache:
+                functions = self.arithmetic = {}
+            functions[expression] = function
+        return function
+
+
+_caches = _Caches()
+
+
+class _Evaluator:
+    """Evaluate template parts against an env dict.
+
+    Parameter values are strings. Indexed arrays are lists and associative
+    arrays are dicts of strings.
+    """
+
+    __slots__ = (
+        "env",
+        "strict",
+        "names",
+        "copy_on_write",
+        "copied",
+        "repeated",
+        "memo",
+        "problems",
+        "argv",
+        "caches",
     )
 
-    for name, value in env_by_decreasing_name_length:
-        s = s.replace(f"${name}", value)
-        name = "{" + name + "}"
-        s = s.replace(f"${name}", value)
-    return s
+    def __init__(self, env, strict=False, copy_on_write=False, argv=(), caches=None):
+        self.env = env
+        self.strict = strict
+        # the sorted parameter names of a FrozenEnv env for ${!prefix*}, set
+        # on demand and kept sorted on assignment
+        self.names = None
+        # if copy_on_write is True, env is copied on the first assignment so
+        # that it is never updated. copied is then the set of the names of
+        # the arrays that were copied too before an element assignment.
+        self.copy_on_write = copy_on_write
+        self.copied = None
+        # the results of the repeated nodes of the template being expanded,
+        # by node. memo is replaced on assignment and is None if the template
+        # has no repeated nodes.
+        self.repeated = None
+        self.memo = None
+        # a list of (kind, name, message) problems in validation mode where
+        # errors are recorded instead of raised, or None
+        self.problems = None
+        # $0 followed by the positional parameters
+        self.argv = argv
+        # the compiled patterns and arithmetic expressions of an Expander or
+        # of the module functions
+        self.caches = _caches if caches is None else caches
+
+    def expand(self, template):
+        """Return the string expanded from a Template."""
+        repeated = self.repeated = template.repeated
+        self.memo = None if repeated is None else {}
+        return self.evaluate(template.code)
+
+    def expand_with_spans(self, template, source_spans):
+        """Return a tuple of (expanded, spans) for a Template whose parts
+        have the (start, end) source_spans.
+        """
+        repeated = self.repeated = template.repeated
+        self.memo = None if repeated is None else {}
+        node = self.compute if repeated is None else self.node
+        expanded = []
+        spans = []
+        out_start = 0
+        for part, (start, end) in zip(template.code, source_spans):
+            if part.__class__ is not str:
+                part = node(part)
+            expanded.append(part)
+            out_end = out_start + len(part)
+            spans.append((start, end, out_start, out_end))
+            out_start = out_end
+        return "".join(expanded), spans
+
+    def evaluate(self, parts):
+        """Return the string expanded from a tuple of template parts."""
+        node = self.compute if self.memo is None else self.node
+        if len(parts) == 1:
+            part = parts[0]
+            return part if part.__class__ is str else node(part)
+        return "".join(
+            [part if part.__class__ is str else node(part) for part in parts]
+        )
+
+    def node(self, node):
+        """Return the string expanded from a node, memoized if the node is
+        repeated in the template.
+        """
+        memo = self.memo
+        if memo is None or node not in self.repeated:
+            return self.compute(node)
+        value = memo.get(node)
+        if value is None:
+            value = self.compute(node)
+            # results are not memoized if an assignment happened meanwhile
+            if self.memo is memo:
+                memo[node] = value
+        return value
+
+    def compute(self, node):
+        kind = node[0]
+        if kind == "{" or kind == "!":
+            return self.brace(node)
+        if kind == "$":
+            return self.plain(node[1])
+        if kind == "#":
+            return self.length(node)
+        if kind == "((":
+            return str(self.arithmetic(self.evaluate(node[1])))
+        if kind == "!*":
+            return self.names_with_prefix(self.name(node[1]))
+        if kind == "![":
+            return self.keys(self.name(node[1]))
+        if kind == "~":
+            return self.tilde(node[1])
+        # kind == "q"
+        return _glob_escape(self.node(node[1]))
+
+    def name(self, name):
+        if name.__class__ is str:
+            return name
+        return self.evaluate(name)
+
+    def unset(self, name):
+        """Return an empty string for the unset parameter name."""
+        if self.strict:
+            if self.problems is None:
+                raise ParameterExpansionNullError(name)
+            self.problems.append(("unset", name, "parameter not set"))
+        return ""
+
+    def null(self, name, value, message):
+        """Raise a ParameterExpansionNullError for a ${name:?message} or
+        ${name?message} expansion of an unset or null value, or record it and
+        return an empty string in validation mode.
+        """
+        if self.problems is None:
+            raise ParameterExpansionNullError(f"{name}: {message}")
+        self.problems.append(("unset" if value is None else "null", name, message))
+        return ""
+
+    def lookup(self, name, index=None):
+        """Return the value of the parameter name or of its element at index:
+        None if unset, a string or a list of strings if index is "@" or "*"
+        and for $@ and $*.
+        """
+        value = self.env.get(name)
+        if value is None:
+            # positional and special parameters are never in env
+            value = _special_parameter(name, self.argv)
+            if value is None or index is None:
+                return value
+        if value.__class__ is str:
+            if index is None:
+                return value
+            if index == "@" or index == "*":
+                return [value]
+            # a scalar is an array with a single element at index 0
+            return value if self.evaluate(index) in ("0", "") else None
+        if index is None:
+            index = ("0",)
+        elif index == "@" or index == "*":
+            return list(value.values() if isinstance(value, dict) else value)
+        if isinstance(value, dict):
+            return value.get(self.evaluate(index))
+        key = self.integer(index)
+        if -len(value) <= key < len(value):
+            return value[key]
+        return None
+
+    def assign(self, name, index, value):
+        """Assign a string value to the parameter name or to its element at
+        index, or assign a list value to the parameter name.
+        """
+        if not name:
+            raise ParameterExpansionParseError("Invalid indirect expansion")
+        if _special_name(name):
+            raise ParameterExpansionParseError("Cannot assign in this way", name)
+        if self.memo is not None:
+            self.memo = {}
+        if self.copy_on_write:
+            self.env = dict(self.env)
+            self.copy_on_write = False
+            self.copied = set()
+            if self.names is not None:
+                self.names = list(self.names)
+        env = self.env
+        if env.__class__ is FrozenEnv:
+            env._readonly()
+        names = self.names
+        if names is not None and name not in env:
+            insort(names, name)
+        if index is None:
+            current = env.get(name)
+            if current is None or current.__class__ is str or value.__class__ is list:
+                env[name] = value
+                return
+            index = ("0",)
+        elif index == "@" or index == "*":
+            raise ParameterExpansionParseError("Bad array subscript", name)
+        array = env.get(name)
+        copied = self.copied
+        if copied is not None and name not in copied and array is not None:
+            copied.add(name)
+            if array.__class__ is not str:
+                array = env[name] = array.copy()
+        if isinstance(array, dict):
+            array[self.evaluate(index)] = value
+            return
+        if array is None or array.__class__ is str:
+            array = env[name] = [] if array is None else [array]
+        key = self.integer(index)
+        if key < 0:
+            key += len(array)
+        if key >= len(array):
+            array.extend([""] * (key + 1 - len(array)))
+        array[key] = value
+
+    def plain(self, word):
+        env = self.env
+        value = env.get(word)
+        if value is None:
+            value = _special_parameter(word, self.argv)
+            if value is not None:
+                return value if value.__class__ is str else " ".join(value)
+            # expand the longest parameter name that starts word
+            if env.__class__ is FrozenEnv:
+                name = env.longest_name(word)
+                if name is not None:
+                    return self.lookup(name) + word[len(name) :]
+            else:
+                for end in range(len(word) - 1, 0, -1):
+                    value = env.get(word[:end])
+                    if value is not None:
+                        return self.lookup(word[:end]) + word[end:]
+            if self.strict:
+                return self.unset(word)
+            # unset parameters are left unchanged
+            return "$" + word
+        if value.__class__ is not str:
+            # $array is the same as ${array[0]}
+            value = self.lookup(word) or ""
+        return value
+
+    def indirect(self, name, index):
+        """Return a tuple of (name, index) of the parameter referenced by the
+        value of the parameter name for a ${!name} indirect expansion.
+        """
+        value = self.lookup(name, index)
+        if value is None:
+            return self.unset(name), None
+        if value.__class__ is not str:
+            value = " ".join(value)
+        reference = _match_reference(value)
+        if not reference:
+            raise ParameterExpansionParseError("Invalid indirect expansion", value)
+        name, index = reference.groups()
+        if index is not None and index not in ("@", "*"):
+            index = (index,)
+        return name, index
+
+    def length(self, node):
+        _, name, index = node
+        name = self.name(name)
+        value = self.lookup(name, index)
+        if value is None:
+            return str(len(self.unset(name)))
+        return str(len(value))
+
+    def keys(self, name):
+        value = self.env.get(name)
+        if value is None:
+            return self.unset(name)
+        if value.__class__ is str:
+            return "0"
+        if isinstance(value, dict):
+            return " ".join(value)
+        return " ".join(map(str, range(len(value))))
+
+    def tilde(self, user):
+        """Return the home directory of a ~ or ~user tilde prefix or the prefix
+        unchanged if user is unknown.
+        """
+        if not user:
+            home = self.env.get("HOME")
+            if home.__class__ is str:
+                return home
+            return os.path.expanduser("~")
+        return _home_directory(user)
+
+    def names_with_prefix(self, prefix):
+        names = self.names
+        if names is None:
+            env = self.env
+            if env.__class__ is not FrozenEnv:
+                # without the sorted names of a FrozenEnv, a single pass over
+                # the env is cheaper than sorting all of its names
+                found = [name for name in env if name.startswith(prefix)]
+                found.sort()
+                return " ".join(found)
+            names = self.names = env.names
+        found = []
+        for i in range(bisect_left(names, prefix), len(names)):
+            name = names[i]
+            if not name.startswith(prefix):
+                break
+            found.append(name)
+        return " ".join(found)
+
+    def brace(self, node):
+        kind, name, index, op, word, extra = node
+        if name.__class__ is not str:
+            name = self.evaluate(name)
+        if kind == "!":
+            name, index = self.indirect(name, index)
+        value = self.lookup(name, index) if name else None
+        if value is not None and value.__class__ is not str:
+            if op == ":":
+                # this is an array slice as in ${array[@]:1:2}. Offsets of
+                # ${@:1:2} positional parameters slices start at $0.
+                if name == "@" or name == "*":
+                    value = self.argv
+                return " ".join(self.substring(value, word, extra))
+            if not value:
+                value = None
+            elif op and op[0] in "%#/^,@":
+                # operators apply to each element of the array
+                return " ".join([self.operate(v, op, word, extra) for v in value])
+            else:
+                value = " ".join(value)
+
+        if op == ":-":
+            return value if value else self.evaluate(word)
+        if op == "-":
+            return self.evaluate(word) if value is None else value
+        if op == ":=":
+            if value:
+                return value
+            value = self.evaluate(word)
+            self.assign(name, index, value)
+            return value
+        if op == "=":
+            if value is None:
+                value = self.evaluate(word)
+                self.assign(name, index, value)
+            return value
+        if op == ":?":
+            if value:
+                return value
+            msg = self.evaluate(word) or "parameter null or not set"
+            return self.null(name, value, msg)
+        if op == "?":
+            if value is None:
+                msg = self.evaluate(word) or "parameter not set"
+                return self.null(name, value, msg)
+            return value
+        if op == ":+":
+            return self.evaluate(word) if value else ""
+        if op == "+":
+            return "" if value is None else self.evaluate(word)
+
+        if value is None:
+            value = self.unset(name)
+            if op[:1] in ("@", "/"):
+                # transformations and replacements of unset parameters are
+                # empty
+                return value
+        if not op:
+            return value
+        if op == ":":
+            return self.substring(value, word, extra)
+        return self.operate(value, op, word, extra)
+
+    def operate(self, value, op, word, extra):
+        """Return the value transformed by a pattern, case modification or
+        transformation operator.
+        """
+        kind = op[0]
+        if kind == "%" or kind == "#":
+            match = self.caches.matcher(self.evaluate(word))
+            return _remove_affix(value, match, kind == "%", len(op) == 2)
+        if kind == "^" or kind == ",":
+            pattern = self.evaluate(word) if word else ""
+            match = self.caches.matcher(pattern) if pattern else None
+            return _change_case(value, match, kind == "^", len(op) == 1)
+        if kind == "@":
+            return _TRANSFORMS[op[1]](value)
+        # op is "/", "//", "/#" or "/%"
+        pattern = self.evaluate(word)
+        replacement = "" if extra is None else self.evaluate(extra)
+        if op == "/#":
+            if value.startswith(pattern):
+                return replacement + value[len(pattern) :]
+            return value
+        if op == "/%":
+            if value.endswith(pattern):
+                return value[: len(value) - len(pattern)] + replacement
+            return value
+        if not value or not pattern:
+            return value
+        return value.replace(pattern, replacement, -1 if op == "//" else 1)
+
+    def substring(self, value, offset, length):
+        """Return a slice of a string or a list of strings."""
+        offset = self.integer(offset)
+        size = len(value)
+        if offset < 0:
+            offset += size
+            if offset < 0:
+                return value[:0]
+        if length is None:
+            return value[offset:]
+        length = self.integer(length)
+        if length < 0:
+            return value[offset : size + length]
+        return value[offset : offset + length]
+
+    def integer(self, parts):
+        """Return the integer value of the arithmetic expression in parts."""
+        return self.arithmetic(self.evaluate(parts))
+
+    def arithmetic(self, expression):
+        try:
+            return self.caches.arithmetic_function(expression)(self)
+        except RecursionError as e:
+            raise ParameterExpansionParseError(
+                "Expression recursion level exceeded", expression
+            ) from e
+
+    def arithmetic_variable(self, name, index):
+        """Return the integer value of a parameter in an arithmetic expression."""
+        value = self.lookup(name, index)
+        if value is None:
+            self.unset(name)
+            return 0
+        if value.__class__ is not str:
+            value = self.lookup(name, ("0",)) or ""
+        if _match_number(value) and (value[0] != "0" or len(value) == 1):
+            return _int64(int(value))
+        return self.arithmetic(value)
+
+
+_match_reference = re.compile(r"([A-Za-z_]\w*|\d+)(?:\[(.*)\])?\Z", re.ASCII).match
+
+
+@lru_cache(maxsize=256)
+def _home_directory(user):
+    """Return the home directory of user or ~user if user is unknown."""
+    return os.path.expanduser("~" + user)
+
+
+#
+# Arithmetic: a $((...)) expression is compiled once into a tree of closures
+# that each take an _Evaluator and return an integer. Integers are signed 64
+# bits and wrap around as in Bash. Parameters are evaluated as arithmetic
+# expressions and unset or null parameters evaluate to 0.
+#
+
+_arithmetic_tokens = re.compile(
+    r"""\s*(?:
+    (?P<number>\d[\w@#]*)
+    |(?P<name>[A-Za-z_]\w*)(?:\[(?P<subscript>[^\]]*)\])?
+    |(?P<op>\*\*=|<<=|>>=|\+\+|--|\*\*|<<|>>|<=|>=|==|!=|&&|\|\||[-+*/%&^|]=
+        |[-+*/%&^|<>=!~?:,()])
+    )""",
+    re.ASCII | re.VERBOSE,
+).match
+
+_match_number = re.compile(
+    r"0[xX][0-9a-fA-F]+|0[0-7]*|[1-9]\d*|\d+#[\w@]+", re.ASCII
+).fullmatch
+
+_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ@_"
+
+
+def _int64(n):
+    """Return the integer n wrapped around as a signed 64 bits integer."""
+    if -0x8000000000000000 <= n <= 0x7FFFFFFFFFFFFFFF:
+        return n
+    return (n + 0x8000000000000000) % 0x10000000000000000 - 0x8000000000000000
+
+
+def _arithmetic_integer(number):
+    """Return the integer of a number in an arithmetic expression: a decimal,
+    an 0x hexadecimal, a 0 octal or a base#digits number.
+    """
+    if not _match_number(number):
+        raise ParameterExpansionParseError("Value too great for base", number)
+    if number[:2] in ("0x", "0X"):
+        return _int64(int(number, 16))
+    if "#" not in number:
+        return _int64(int(number, 8 if number[0] == "0" else 10))
+    base, digits = number.split("#", 1)
+    base = int(base)
+    if not 2 <= base <= 64:
+        raise ParameterExpansionParseError("Invalid arithmetic base", number)
+    if base <= 36:
+        digits = digits.lower()
+    n = 0
+    for digit in digits:
+        value = _DIGITS.find(digit)
+        if not 0 <= value < base:
+            raise ParameterExpansionParseError("Value too great for base", number)
+        n = n * base + value
+    return _int64(n)
+
+
+def _divide(a, b):
+    """Return the quotient of a and b truncated toward zero as in C."""
+    if not b:
+        raise ParameterExpansionParseError("Division by 0")
+    quotient = abs(a) // abs(b)
+    return _int64(-quotient if (a < 0) != (b < 0) else quotient)
+
+
+def _modulo(a, b):
+    return _int64(a - b * _divide(a, b))
+
+
+def _power(a, b):
+    if b < 0:
+        raise ParameterExpansionParseError("Exponent less than 0")
+    return _int64(pow(a, b, 0x10000000000000000))
+
+
+_BINARY_OPERATORS = {
+    "*": lambda a, b: _int64(a * b),
+    "/": _divide,
+    "%": _modulo,
+    "+": lambda a, b: _int64(a + b),
+    "-": lambda a, b: _int64(a - b),
+    "<<": lambda a, b: _int64(a << (b & 63)),
+    ">>": lambda a, b: a >> (b & 63),
+    "<": lambda a, b: int(a < b),
+    ">": lambda a, b: int(a > b),
+    "<=": lambda a, b: int(a <= b),
+    ">=": lambda a, b: int(a >= b),
+    "==": lambda a, b: int(a == b),
+    "!=": lambda a, b: int(a != b),
+    "&": lambda a, b: a & b,
+    "^": lambda a, b: a ^ b,
+    "|": lambda a, b: a | b,
+    "**": _power,
+}
+
+# binary operators precedence, from lowest to highest
+_PRECEDENCES = {
+    "||": 1,
+    "&&": 2,
+    "|": 3,
+    "^": 4,
+    "&": 5,
+    "==": 6,
+    "!=": 6,
+    "<": 7,
+    ">": 7,
+    "<=": 7,
+    ">=": 7,
+    "<<": 8,
+    ">>": 8,
+    "+": 9,
+    "-": 9,
+    "*": 10,
+    "/": 10,
+    "%": 10,
+    "**": 11,
+}
+
+_UNARY_OPERATORS = {
+    "-": lambda a: _int64(-a),
+    "+": lambda a: a,
+    "!": lambda a: int(not a),
+    "~": lambda a: ~a,
+}
+
+_ASSIGNMENT_OPERATORS = frozenset(
+    ["=", "*=", "/=", "%=", "+=", "-=", "<<=", ">>=", "&=", "^=", "|=", "**="]
+)
+
+
+class _ArithmeticParser:
+    """Compile an arithmetic expression with precedence climbing."""
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = []
+        pos = 0
+        size = len(expression.rstrip())
+        while pos < size:
+            match = _arithmetic_tokens(expression, pos)
+            if not match:
+                raise ParameterExpansionParseError(
+                    "Syntax error in arithmetic expression", expression[pos:]
+                )
+            self.tokens.append(match)
+            pos = match.end()
+        self.tokens.reverse()
+
+    def peek(self):
+        if self.tokens:
+            return self.tokens[-1].group("op")
+        return None
+
+    def take(self, op=None):
+        if not self.tokens or op is not None and self.peek() != op:
+            raise ParameterExpansionParseError(
+                "Syntax error in arithmetic expression", self.expression
+            )
+        return self.tokens.pop()
+
+    def compile(self):
+        if not self.tokens:
+            return lambda evaluator: 0
+        function = self.comma()
+        if self.tokens:
+            raise ParameterExpansionParseError(
+                "Syntax error in arithmetic expression", self.expression
+            )
+        return function
+
+    def comma(self):
+        function = self.assignment()
+        while self.peek() == ",":
+            self.take()
+            first, second = function, self.assignment()
+
+            def function(evaluator, first=first, second=second):
+                first(evaluator)
+                return second(evaluator)
+
+        return function
+
+    def assignment(self):
+        function = self.ternary()
+        op = self.peek()
+        if op not in _ASSIGNMENT_OPERATORS:
+            return function
+        self.take()
+        value = self.assignment()
+        lvalue = getattr(function, "lvalue", None)
+        if lvalue is None:
+            raise ParameterExpansionParseError(
+                "Attempted assignment to non-variable", self.expression
+            )
+        name, index = lvalue
+        operate = _BINARY_OPERATORS.get(op[:-1])
+
+        def assign(evaluator):
+            result = value(evaluator)
+            if operate is not None:
+                result = operate(function(evaluator), result)
+            evaluator.assign(name, index, str(result))
+            return result
+
+        return assign
+
+    def ternary(self):
+        condition = self.binary(1)
+        if self.peek() != "?":
+            return condition
+        self.take()
+        if_true = self.assignment()
+        self.take(":")
+        if_false = self.assignment()
+        return lambda evaluator: (
+            if_true(evaluator) if condition(evaluator) else if_false(evaluator)
+        )
+
+    def binary(self, precedence):
+        left = self.unary()
+        while True:
+            op = self.peek()
+            op_precedence = _PRECEDENCES.get(op)
+            if op_precedence is None or op_precedence < precedence:
+                return left
+            self.take()
+            # ** is right associative
+            right = self.binary(op_precedence + (op != "**"))
+            if op == "&&":
+                left = lambda e, a=left, b=right: int(bool(a(e) and b(e)))
+            elif op == "||":
+                left = lambda e, a=left, b=right: int(bool(a(e) or b(e)))
+            else:
+                operate = _BINARY_OPERATORS[op]
+                left = lambda e, a=left, b=right, operate=operate: operate(a(e), b(e))
+
+    def unary(self):
+        op = self.peek()
+        if op in _UNARY_OPERATORS:
+            self.take()
+            operand = self.unary()
+            operate = _UNARY_OPERATORS[op]
+            return lambda evaluator: operate(operand(evaluator))
+        if op in ("++", "--"):
+            self.take()
+            operand = self.unary()
+            if not hasattr(operand, "lvalue"):
+                # this is two unary operators as in --1 that cancel out
+                return operand
+            return self.increment(operand, op, prefix=True)
+        function = self.primary()
+        op = self.peek()
+        if op in ("++", "--") and hasattr(function, "lvalue"):
+            self.take()
+            return self.increment(function, op, prefix=False)
+        return function
+
+    def increment(self, function, op, prefix):
+        lvalue = getattr(function, "lvalue", None)
+        if lvalue is None:
+            raise ParameterExpansionParseError(
+                "Attempted assignment to non-variable", self.expression
+            )
+        name, index = lvalue
+        step = 1 if op == "++" else -1
+
+        def increment(evaluator):
+            value = function(evaluator)
+            result = _int64(value + step)
+            evaluator.assign(name, index, str(result))
+            return result if prefix else value
+
+        return increment
+
+    def primary(self):
+        token = self.take()
+        if token.group("op") == "(":
+            function = self.comma()
+            self.take(")")
+            return function
+        number = token.group("number")
+        if number is not None:
+            value = _arithmetic_integer(number)
+            return lambda evaluator: value
+        name = token.group("name")
+        if name is None:
+            raise ParameterExpansionParseError(
+                "Syntax error in arithmetic expression", self.expression
+            )
+        index = token.group("subscript")
+        if index is not None:
+            index = (index,)
+
+        def variable(evaluator):
+            return evaluator.arithmetic_variable(name, index)
+
+        variable.lvalue = (name, index)
+        return variable
+
+
+def _change_case(value, match, upper, first):
+    """Return value with its first character or all its characters matching
+    the compiled pattern match converted to upper or lower case. A None match
+    matches any character.
+    """
+    convert = str.upper if upper else str.lower
+    if match is None:
+        return convert(value[:1]) + value[1:] if first else convert(value)
+    if first:
+        return convert(value[:1]) + value[1:] if match(value[:1]) else value
+    return "".join([convert(c) if match(c) else c for c in value])
+
+
+def _upper_first(value):
+    return value[:1].upper() + value[1:]
+
+
+def _lower_first(value):
+    return value[:1].lower() + value[1:]
+
+
+def _quote(value):
+    """Return value quoted so that it can be reused as input."""
+    return "'" + value.replace("'", "'\\''") + "'"
+
+
+_ESCAPES = {
+    "a": "\a",
+    "b": "\b",
+    "e": "\x1b",
+    "E": "\x1b",
+    "f": "\f",
+    "n": "\n",
+    "r": "\r",
+    "t": "\t",
+    "v": "\v",
+    "\\": "\\",
+    "'": "'",
+    '"': '"',
+    "?": "?",
+}
+
+_backslash_escapes = re.compile(
+    r"\\(?:([abeEfnrtv\\'\"?])|([0-7]{1,3})|x([0-9a-fA-F]{1,2})"
+    r"|u([0-9a-fA-F]{1,4})|U([0-9a-fA-F]{1,8})|c(.))",
+    re.DOTALL,
+).sub
+
+
+def _unescape_match(match):
+    char, octal, *hexadecimals, control = match.groups()
+    if char:
+        return _ESCAPES[char]
+    if octal:
+        return chr(int(octal, 8) & 0xFF)
+    for hexadecimal in hexadecimals:
+        if hexadecimal:
+            return chr(min(int(hexadecimal, 16), sys.maxunicode))
+    return chr(ord(control) & 0x1F)
+
+
+def _unescape(value):
+    """Return value with backslash escape sequences expanded as in $'...'."""
+    if "\\" not in value:
+        return value
+    return _backslash_escapes(_unescape_match, value)
+
+
+# ${foo@<letter>} transformations, by letter
+_TRANSFORMS = {
+    "U": str.upper,
+    "u": _upper_first,
+    "L": str.lower,
+    "Q": _quote,
+    "E": _unescape,
+}
+
+
+def _value_transform(code, name):
+    """Return a function of a value for template code made of a single
+    ${name} expansion with a case modification or transformation operator
+    that does not depend on the env, or None.
+    """
+    if len(code) != 1 or code[0].__class__ is str:
+        return None
+    kind, *node = code[0]
+    if kind != "{" or node[:2] != [name, None] or node[3:] != [(), None]:
+        return None
+    op = node[2]
+    if not op:
+        return str
+    if op[0] == "@":
+        return _TRANSFORMS[op[1]]
+    return _CASE_TRANSFORMS.get(op)
+
+
+_CASE_TRANSFORMS = {
+    "^": _upper_first,
+    "^^": str.upper,
+    ",": _lower_first,
+    ",,": str.lower,
+}
+
+# operators that do not raise on unset parameters in strict mode
+_DEFAULT_OPERATORS = frozenset(["-", ":-", "+", ":+"])
+
+
+def _column_parts(code, columns, numpy):
+    """Return a list of the parts of template code for a column-wise
+    expansion of columns, or None if the template must be expanded row by row.
+
+    Parts are literal strings, ("c", name, op, word, extra) expansions of the
+    column name with an operator op ("$" for a $name expansion) and literal
+    word and extra parts, or expansion nodes that do not depend on columns.
+    Assignment and error operators are not supported. If numpy is True, only
+    plain, default and alternate operators are supported.
+    """
+    parts = []
+    for part in code:
+        if part.__class__ is str:
+            parts.append(part)
+            continue
+        kind = part[0]
+        if kind == "$":
+            word = part[1]
+            if word in columns:
+                parts.append(("c", word, "$", (), None))
+            elif any(word.startswith(name) for name in columns):
+                # this may be the expansion of a column followed by a literal
+                return None
+            else:
+                parts.append(part)
+            continue
+        if kind != "{":
+            return None
+        _, name, index, op, word, extra = part
+        if name.__class__ is not str or index is not None:
+            return None
+        if op and op not in _DEFAULT_OPERATORS:
+            if numpy or "=" in op or "?" in op:
+                return None
+        if any(w.__class__ is not str for w in word + (extra or ())):
+            return None
+        if name in columns:
+            parts.append(("c", name, op, word, extra))
+        else:
+            parts.append(part)
+    return parts
+
+
+def _column_values(evaluator, values, name, op, word, extra):
+    """Return a list of the expansions of the values of a column name with an
+    operator op and literal word and extra parts.
+    """
+    if op == "$":
+        if None not in values:
+            return values
+        return ["$" + name if v is None else v for v in values]
+    if not op:
+        if None not in values:
+            return values
+        return ["" if v is None else v for v in values]
+    if op in _DEFAULT_OPERATORS:
+        word = "".join(word)
+        if op == ":-":
+            return [v or word for v in values]
+        if op == "-":
+            return [word if v is None else v for v in values]
+        if op == ":+":
+            return [word if v else "" for v in values]
+        return ["" if v is None else word for v in values]
+    if op == ":":
+        substring = evaluator.substring
+        return ["" if v is None else substring(v, word, extra) for v in values]
+    operate = evaluator.operate
+    return ["" if v is None else operate(v, op, word, extra) for v in values]
+
+
+def _concatenate_columns(pieces, size):
+    """Return a list of size strings concatenated from pieces that are either
+    strings or columns of strings.
+    """
+    columns = [piece for piece in pieces if piece.__class__ is not str]
+    if not columns:
+        return ["".join(pieces)] * size
+    if len(pieces) == 1:
+        return list(columns[0])
+    format_string = "".join(
+        piece.replace("{", "{{").replace("}", "}}") if piece.__class__ is str else "{}"
+        for piece in pieces
+    )
+    return list(map(format_string.format, *columns))
+
+
+def _numpy_columns(columns):
+    """Return a tuple of (numpy, columns). numpy is the NumPy module if all
+    the columns are NumPy string arrays, or None and NumPy arrays in columns
+    are converted to lists.
+
+    NumPy is an optional dependency: it is only used if it was imported to
+    create the columns.
+    """
+    numpy = sys.modules.get("numpy")
+    if numpy is None or not columns:
+        return None, columns
+    arrays = [isinstance(values, numpy.ndarray) for values in columns.values()]
+    if not any(arrays):
+        return None, columns
+    if all(arrays) and all(v.dtype.kind == "U" for v in columns.values()):
+        return numpy, columns
+    columns = {
+        name: values.tolist() if is_array else values
+        for (name, values), is_array in zip(columns.items(), arrays)
+    }
+    return None, columns
+
+
+_NONE_TYPE = type(None)
+
+
+def _column_list(name, values):
+    """Return a list of the values of the column name, where missing values
+    such as NaN or pandas.NA are None. Raise a TypeError for other values
+    that are not strings.
+    """
+    values = list(values)
+    if set(map(type, values)) <= {str, _NONE_TYPE}:
+        return values
+    pandas = sys.modules.get("pandas")
+    for i, value in enumerate(values):
+        if value is None or isinstance(value, str):
+            continue
+        if isinstance(value, float) and value != value:
+            values[i] = None
+        elif pandas is not None and pandas.isna(value):
+            values[i] = None
+        else:
+            raise TypeError(f"Column {name!r} has a non-string value: {value!r}")
+    return values
+
+
+def _numpy_column_values(numpy, values, op, word):
+    """Return the expansions of a NumPy string array of values with a plain,
+    default or alternate operator op and a literal word.
+    """
+    if op == ":-":
+        return numpy.where(values == "", word, values)
+    if op == "+":
+        return word
+    if op == ":+":
+        return numpy.where(values == "", "", word)
+    return values
+
+
+def _numpy_concatenate(numpy, pieces, size):
+    """Return a NumPy array of size strings concatenated from pieces that
+    are either strings or NumPy string arrays.
+    """
+    concatenated = numpy.full(size, "")
+    for is_str, group in groupby(pieces, key=lambda piece: piece.__class__ is str):
+        if is_str:
+            concatenated = numpy.char.add(concatenated, "".join(group))
+        else:
+            for piece in group:
+                concatenated = numpy.char.add(concatenated, piece)
+    return concatenated
 
 
 def remove_affix(subst, shl, suffix=True):
@@ -215,27 +2124,13 @@ def remove_affix(subst, shl, suffix=True):
        in parameter, with the largest portion of the prefix matched by the
        pattern deleted.
     """
-    largest = False
-    # at this stage shl has already been trimmed from its leading % or # so
-    # we check for a second % or # to find if we need a largest match or not
+    # shl has already been trimmed from its leading % or # so we check for a
+    # second % or # to find if we need a largest match or not
     pat = "".join(shl)
-    if pat.startswith("%" if suffix else "#"):
-        largest = True
+    largest = pat.startswith("%" if suffix else "#")
+    if largest:
         pat = pat[1:]
-    size = len(subst)
-    indices = range(0, size)
-    if largest != suffix:
-        indices = reversed(indices)
-    if suffix:
-        for i in indices:
-            if fnmatchcase(subst[i:], pat):
-                return subst[:i]
-        return subst
-    else:
-        for i in indices:
-            if fnmatchcase(subst[:i], pat):
-                return subst[i:]
-        return subst
+    return _remove_affix(subst, _caches.matcher(pat), suffix, largest)
 
 
 def remove_suffix(subst, shl):
@@ -244,192 +2139,3 @@ def remove_suffix(subst, shl):
 
 def remove_prefix(subst, shl):
     return remove_affix(subst=subst, shl=shl, suffix=False)
-
-
-def is_whitespace(s):
-    return all(c in " \t\n" for c in s)
-
-
-def follow_brace(shl, env, strict=False):
-    """Expand and return expanded value up to the closing curly brace in
-    ``shl``.
-    """
-    param = next(shl)
-    logger_debug("follow_brace: param:", repr(param))
-    if param == "#":
-        word = next(shl)
-
-        try:
-            subst = env[word]
-        except KeyError:
-            if strict:
-                raise ParameterExpansionNullError(word)
-            else:
-                subst = ""
-        return str(len(subst))
-
-    try:
-        subst = env[param]
-    except KeyError:
-        if strict:
-            raise ParameterExpansionNullError(param)
-        else:
-            subst = ""
-
-    logger_debug("follow_brace: subst:", repr(subst))
-    param_unset = param not in env
-    param_set_and_not_null = bool(subst and (param in env))
-    try:
-        modifier = next(shl)
-        logger_debug("follow_brace: modifier:", repr(modifier))
-        if is_whitespace(modifier):
-            pass
-        elif modifier == "%":
-            return remove_suffix(subst, shl)
-        elif modifier == "#":
-            return remove_prefix(subst, shl)
-        elif modifier == ":":
-            modifier = next(shl)
-            if modifier == "-":
-                word = next(shl)
-                if param_set_and_not_null:
-                    return subst
-                return word
-            elif modifier == "=":
-                word = next(shl)
-                if param_set_and_not_null:
-                    return subst
-                env[param] = word
-                return word
-            elif modifier == "?":
-                if param_set_and_not_null:
-                    return subst
-                raise ParameterExpansionNullError(shl)
-            elif modifier == "+":
-                if param_set_and_not_null:
-                    return next(shl)
-                return subst  # ""
-            elif modifier.isdigit() or modifier == ":":
-
-                # This is a Substring Expansion as in ${foo:4:2}, ${foo::2},
-                # ${foo:4:} or ${foo:4:2} in the generale form of
-                # ${parameter:start:length}. No start means start=0. No length
-                # means everything from start to end. This is a bash'ism, and
-                # not POSIX.
-                # see https://www.gnu.org/software/bash/manual/html_node/Shell-Parameter-Expansion.html
-
-                logger_debug(f"    in substring: modifier1: {modifier}")
-
-                if modifier == ":":
-                    # if there is no start we have a slice that's {$foo::2}
-                    start = 0
-                    try:
-                        length = int(next(shl))
-                    except StopIteration:
-                        # if there is no length we have a slice that's {$foo::}
-                        # no slice in bash means length = 0
-                        length = 0
-                        return ""
-                else:
-                    try:
-                        start = int(modifier)
-                    except ValueError as e:
-                        raise ParameterExpansionParseError(
-                            "Not a bash substring", shl
-                        ) from e
-
-                    try:
-                        modifier = next(shl)
-                    except StopIteration:
-                        # There is only a start and no length as in ${foo:4} and
-                        # the length is therefore everything to the end i.e.
-                        # with foo=123456 ${foo:4} is 56
-                        if param_set_and_not_null:
-                            return subst[start:]
-                        else:
-                            return subst
-
-                    if modifier != ":":
-                        raise ParameterExpansionParseError(
-                            "Illegal substring argument", shl
-                        )
-
-                    try:
-                        length = int(next(shl))
-                    except StopIteration:
-                        # If there is no length we have a substring that's
-                        # {$foo::} no length in bash means length = 0
-                        length = 0
-                        return ""
-
-                if param_set_and_not_null:
-                    return subst[start : start + length]
-                return subst
-            else:
-                raise ParameterExpansionParseError()
-
-        elif modifier == "/":
-            # This is a string replacement as in replace foo by bar using / as
-            # sep.
-            arg1 = next(shl)
-            logger_debug("follow_brace: subst/1: arg1.1:", repr(arg1))
-            replace_all = False
-            if arg1 == "/":
-                # with // replace all occurences
-                replace_all = True
-                arg1 = next(shl)
-
-            has_sep = False
-
-            # join anything in between the start / and middle /
-            for na in shl:
-                logger_debug("follow_brace: subst/1: shl/na:", repr(na))
-                if na == "/":
-                    has_sep = True
-                    break
-                arg1 += na
-
-            logger_debug(
-                "follow_brace: subst/1: arg1.2:", repr(arg1), "has_sep:", has_sep
-            )
-
-            arg2 = ""
-            if has_sep:
-                # Join anything in between the after the middle / until the end.
-                # Note: the arg2 replacement value of a replacement may be empty
-                for na in shl:
-                    arg2 += na
-
-            if param_set_and_not_null:
-                if replace_all:
-                    return subst.replace(arg1, arg2)
-                else:
-                    return subst.replace(arg1, arg2, 1)
-
-            return subst
-
-        else:
-            if modifier == "-":
-                word = next(shl)
-                if param_unset:
-                    return word
-                return subst  # may be ""
-            elif modifier == "=":
-                word = next(shl)
-                if param_unset:
-                    env[param] = word
-                    return word
-                return subst  # may be ""
-            elif modifier == "?":
-                if param_unset:
-                    msg = "".join(shl) or "parameter '$parameter' not found"
-                    raise ParameterExpansionNullError(msg)
-                return subst  # may be ""
-            elif modifier == "+":
-                word = next(shl)
-                if param_unset:
-                    return subst  # ""
-                return word
-            raise ParameterExpansionParseError()
-    except StopIteration:
-        return subst
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+"""
+Benchmark parameter_expansion.expand() in each dialect.
+
+Each dialect expands strings that use the expansions it supports, with the
+templates already compiled and cached. The bash and posix dialects also
+expand the same strings so that their timings can be compared::
+
+    python tests/bench_pe.py --number 20000
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+try:
+    import parameter_expansion as pex
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+    import parameter_expansion as pex
+
+ENV = {"HOME": "/home/user", "name": "foo.tar.gz", "version": "1.2.3", "empty": ""}
+
+COMMON = [
+    "plain text without expansions",
+    "$HOME/${name}",
+    "${empty:-default}-${version:+set}-${unset-x}",
+]
+
+STRINGS = {
+    "bash": COMMON + ["${name%%.*}-${version#*.}", "${name/./-}${version:2:1}"],
+    "posix": COMMON + ["${name%%.*}-${version#*.}", "$((1 + 2))${#name}"],
+    "compose": COMMON + ["$$HOME/${name:?required}"],
+    "envsubst": COMMON[:2] + ["$HOME ${name} ${other:-kept}"],
+}
+
+
+def bench(dialect, number):
+    """Return the mean time in seconds to expand one string of dialect."""
+    strings = STRINGS[dialect]
+
+    def run():
+        for s in strings:
+            pex.expand(s, env=ENV, dialect=dialect)
+
+    best = min(timeit.repeat(run, number=number, repeat=5))
+    return best / number / len(strings)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--number", type=int, default=10000)
+    args = parser.parse_args(argv)
+    for dialect in STRINGS:
+        print(f"{dialect:9} {bench(dialect, args.number) * 1e6:6.2f} us/expansion")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
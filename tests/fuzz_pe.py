@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+
+"""
+Differential fuzzing of parameter_expansion.expand() against a local bash.
+
+Random environments and expansion strings are generated across all the
+supported operators and expanded both with expand() and with ``bash -c``.
+Any mismatch is shrunk to a minimal string and environment and reported. The
+throughput of both engines is reported at the end.
+
+Run it with a time budget in seconds::
+
+    python tests/fuzz_pe.py --budget 60 --seed 42
+
+The generated strings avoid the few areas where this library deliberately
+differs from bash, such as $name references to unset parameters that are
+left unchanged or ${foo/bar/baz} replacements that use plain strings and not
+patterns.
+"""
+
+import argparse
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+
+try:
+    import parameter_expansion as pex
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+    import parameter_expansion as pex
+
+SCALARS = ["foo", "bar", "foo_bar", "x"]
+NUMBERS = ["n", "m"]
+ARRAYS = ["arr"]
+UNSET = ["unset", "nope"]
+REFS = ["ref"]
+
+VALUE_CHARS = "abcABC.-_/: 0123"
+PATTERN_CHARS = "abcA.-/*?"
+PLAIN_PATTERN_CHARS = "abcA.-/"
+LITERAL_CHARS = "abc.-_/:,@%+="
+
+# Marker of an expansion error in bash output and in expand() results
+ERROR = "\x01"
+
+
+class Case:
+    """An expansion string with the environment to expand it with."""
+
+    def __init__(self, s, env):
+        self.s = s
+        self.env = env
+
+    def __repr__(self):
+        return f"Case({self.s!r}, env={self.env!r})"
+
+
+def random_text(rnd, chars, size):
+    return "".join(rnd.choice(chars) for _ in range(rnd.randint(0, size)))
+
+
+def random_env(rnd):
+    env = {}
+    for name in SCALARS:
+        if rnd.random() < 0.8:
+            env[name] = random_text(rnd, VALUE_CHARS, 8)
+    for name in NUMBERS:
+        env[name] = str(rnd.randint(-5, 20))
+    for name in ARRAYS:
+        env[name] = [random_text(rnd, VALUE_CHARS, 5) for _ in range(rnd.randint(1, 4))]
+    for name in REFS:
+        env[name] = rnd.choice(SCALARS + NUMBERS + UNSET)
+    return env
+
+
+def random_arithmetic(rnd, depth=0):
+    choice = rnd.random()
+    if depth > 2 or choice < 0.3:
+        return str(rnd.randint(-3, 12))
+    if choice < 0.5:
+        return rnd.choice(NUMBERS + UNSET)
+    if choice < 0.6:
+        return rnd.choice(["-", "!", "~"]) + random_arithmetic(rnd, depth + 1)
+    if choice < 0.7:
+        return f"({random_arithmetic(rnd, depth + 1)})"
+    if choice < 0.8:
+        return (
+            f"{random_arithmetic(rnd, depth + 1)} ? "
+            f"{random_arithmetic(rnd, depth + 1)} : {random_arithmetic(rnd, depth + 1)}"
+        )
+    op = rnd.choice(
+        ["+", "-", "*", "/", "%", "<<", ">>", "<", "<=", "==", "!=", "&", "|", "^"]
+        + ["&&", "||"]
+    )
+    left = random_arithmetic(rnd, depth + 1)
+    return f"{left} {op} {random_arithmetic(rnd, depth + 1)}"
+
+
+def random_word(rnd, depth, chars=LITERAL_CHARS):
+    parts = []
+    for _ in range(rnd.randint(0, 2)):
+        if depth < 2 and rnd.random() < 0.3:
+            parts.append(random_expansion(rnd, depth + 1))
+        else:
+            parts.append(random_text(rnd, chars, 3))
+    return "".join(parts)
+
+
+def random_expansion(rnd, depth=0):
+    name = rnd.choice(SCALARS + UNSET)
+    choice = rnd.randint(0, 16)
+    if choice == 0:
+        # followed by a non-name character: $foobar may expand $foo
+        return f"${rnd.choice(list(SCALARS))}-"
+    if choice == 1:
+        return f"${{{name}}}"
+    if choice == 2:
+        op = rnd.choice([":-", "-", ":+", "+", ":=", "="])
+        return f"${{{name}{op}{random_word(rnd, depth)}}}"
+    if choice == 3:
+        return f"${{#{name}}}"
+    if choice == 4:
+        op = rnd.choice(["%", "%%", "#", "##"])
+        pattern = random_text(rnd, PATTERN_CHARS, 3)
+        return f"${{{name}{op}{pattern}}}"
+    if choice == 5:
+        op = rnd.choice(["/", "//", "/#", "/%"])
+        pattern = random_text(rnd, PLAIN_PATTERN_CHARS, 2) or "a"
+        replacement = random_text(rnd, PLAIN_PATTERN_CHARS, 3)
+        return f"${{{name}{op}{pattern}/{replacement}}}"
+    if choice == 6:
+        offset = rnd.randint(-4, 6)
+        # a space is needed before a negative offset
+        offset = f" {offset}" if offset < 0 else str(offset)
+        if rnd.random() < 0.5:
+            return f"${{{name}:{offset}}}"
+        return f"${{{name}:{offset}:{rnd.randint(0, 6)}}}"
+    if choice == 7:
+        op = rnd.choice(["^", "^^", ",", ",,"])
+        pattern = rnd.choice(["", "[abc]", "a", "?"])
+        return f"${{{name}{op}{pattern}}}"
+    if choice == 8:
+        return f"${{{name}@{rnd.choice('UuLQE')}}}"
+    if choice == 9:
+        return f"$(({random_arithmetic(rnd)}))"
+    if choice == 10:
+        index = rnd.choice(["0", "1", "2", "-1", "@", "*", "n % 3", "$n % 2"])
+        return f"${{arr[{index}]}}"
+    if choice == 11:
+        return rnd.choice(["${#arr[@]}", "${!arr[@]}", "${arr[@]%?}", "${arr[@]^}"])
+    if choice == 12:
+        return f"${{arr[@]:{rnd.randint(0, 3)}:{rnd.randint(0, 3)}}}"
+    if choice == 13:
+        return "${!ref}"
+    if choice == 14:
+        return rnd.choice(["${!fo*}", "${!foo@}", "${!n*}"])
+    if choice == 15:
+        op = rnd.choice([":-", ":+"])
+        return f"${{{name}{op}{random_expansion(rnd, depth + 1)}}}"
+    return random_text(rnd, LITERAL_CHARS, 4)
+
+
+def unset_plain_names(case):
+    """Return a list of the names of $name references that are not set."""
+    return [n for n in re.findall(r"\$(\w+)", case.s) if n not in case.env]
+
+
+def random_case(rnd):
+    s = "".join(random_expansion(rnd) for _ in range(rnd.randint(1, 3)))
+    env = random_env(rnd)
+    # $unset is left unchanged on purpose
+    for name in unset_plain_names(Case(s, env)):
+        env[name] = random_text(rnd, VALUE_CHARS, 8)
+    # ${!ref} of an unset parameter is an error in bash
+    if "${!ref}" in s and env["ref"] in UNSET:
+        env["ref"] = "foo"
+        env.setdefault("foo", "")
+    return Case(s, env)
+
+
+def shell_quote(value):
+    return "'" + value.replace("'", "'\\''") + "'"
+
+
+def bash_setup(env):
+    lines = []
+    for name, value in env.items():
+        if isinstance(value, list):
+            lines.append(f"{name}=({' '.join(map(shell_quote, value))})")
+        else:
+            lines.append(f"{name}={shell_quote(value)}")
+    return "; ".join(lines)
+
+
+def bash_script(cases):
+    """Return a bash script that prints the expansion of each case."""
+    lines = ["shopt -u patsub_replacement 2>/dev/null"]
+    for case in cases:
+        setup = bash_setup(case.env) or ":"
+        # eval the expansion so that a syntax error only fails this case
+        lines.append(
+            f"( {setup}; eval r={shell_quote(case.s)} && printf '%s\\0' \"$r\" ) "
+            f"2>/dev/null || printf '\\001\\0'"
+        )
+    return "\n".join(lines) + "\n"
+
+
+def bash_expand_all(cases, bash="bash"):
+    """Return a list of the bash expansions of cases."""
+    script = bash_script(cases)
+    result = subprocess.run(
+        [bash, "--norc", "--noprofile"],
+        input=script.encode("utf-8"),
+        stdout=subprocess.PIPE,
+        env={"PATH": os.environ.get("PATH", ""), "LC_ALL": "C"},
+        check=True,
+    )
+    outputs = result.stdout.decode("utf-8").split("\0")[:-1]
+    assert len(outputs) == len(cases), (len(outputs), len(cases))
+    return outputs
+
+
+def expand(case):
+    env = {k: list(v) if isinstance(v, list) else v for k, v in case.env.items()}
+    try:
+        return pex.expand(case.s, env=env)
+    except (LookupError, pex.pe.ParameterExpansionParseError):
+        return ERROR
+
+
+def mismatch_kind(case, bash="bash"):
+    """Return None if case expands the same with expand() and bash or a tuple
+    of which of them failed otherwise.
+    """
+    result = expand(case)
+    bash_result = bash_expand_all([case], bash=bash)[0]
+    if result == bash_result:
+        return None
+    return result == ERROR, bash_result == ERROR
+
+
+def shrink(case, bash="bash"):
+    """Return a minimal Case that still mismatches with bash in the same way.
+
+    Candidates with $name references to unset parameters or whose expand()
+    result contains a dollar sign are skipped: the generated strings never
+    contain literal dollar signs, so these are expansions that are left
+    unchanged on purpose, such as $unset or an unterminated ${.
+    """
+    kind = mismatch_kind(case, bash)
+
+    def still_mismatches(candidate):
+        if not candidate.s or unset_plain_names(candidate) or "$" in expand(candidate):
+            return False
+        return mismatch_kind(candidate, bash) == kind
+
+    # drop environment variables that are not needed
+    for name in list(case.env):
+        env = dict(case.env)
+        del env[name]
+        candidate = Case(case.s, env)
+        if still_mismatches(candidate):
+            case = candidate
+
+    # remove chunks of the expansion string, from large to single characters
+    chunk = len(case.s) // 2
+    while chunk:
+        start = 0
+        while start < len(case.s):
+            candidate = Case(case.s[:start] + case.s[start + chunk :], case.env)
+            if still_mismatches(candidate):
+                case = candidate
+            else:
+                start += chunk
+        chunk //= 2
+    return case
+
+
+def fuzz(
+    budget=10.0, seed=None, batch=200, bash="bash", max_cases=None, out=sys.stdout
+):
+    """Run the differential fuzzing for a budget of seconds and return a list
+    of shrunk mismatching cases.
+    """
+    rnd = random.Random(seed)
+    found = []
+    count = 0
+    python_time = 0.0
+    bash_time = 0.0
+    deadline = time.monotonic() + budget
+    while time.monotonic() < deadline and (max_cases is None or count < max_cases):
+        size = batch if max_cases is None else min(batch, max_cases - count)
+        cases = [random_case(rnd) for _ in range(size)]
+        start = time.perf_counter()
+        expected = bash_expand_all(cases, bash=bash)
+        bash_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        results = [expand(case) for case in cases]
+        python_time += time.perf_counter() - start
+
+        count += len(cases)
+        for case, result, bash_result in zip(cases, results, expected):
+            if result != bash_result:
+                shrunk = shrink(case, bash=bash)
+                found.append(shrunk)
+                print(
+                    f"MISMATCH: {shrunk!r}\n"
+                    f"  expand: {expand(shrunk)!r}\n"
+                    f"  bash:   {bash_expand_all([shrunk], bash=bash)[0]!r}",
+                    file=out,
+                )
+
+    if count:
+        print(
+            f"{count} cases, {len(found)} mismatches\n"
+            f"  expand: {count / python_time:,.0f} expansions/s\n"
+            f"  bash:   {count / bash_time:,.0f} expansions/s",
+            file=out,
+        )
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--budget", type=float, default=10.0, help="seconds")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--batch", type=int, default=200)
+    parser.add_argument("--bash", default="bash", help="path to bash")
+    args = parser.parse_args(argv)
+    found = fuzz(budget=args.budget, seed=args.seed, batch=args.batch, bash=args.bash)
+    return 1 if found else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
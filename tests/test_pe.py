@@ -1,3 +1,7 @@
+import copy
+import os
+import pickle
+import shutil
 from collections import namedtuple
 
 import pytest  # type: ignore
@@ -607,3 +611,790 @@ def test_tokenize_preserves_spaces():
         " ",
     ]
     assert tokens == expected
+
+
+def test_remove_affix_can_match_the_whole_string_or_nothing():
+    env = dict(parameter="abc")
+    assert pex.expand("${parameter%*}", env=env) == "abc"
+    assert pex.expand("${parameter%%*}", env=env) == ""
+    assert pex.expand("${parameter#*}", env=env) == "abc"
+    assert pex.expand("${parameter##*}", env=env) == ""
+
+
+def test_expand_removes_quotes_in_braces():
+    env = dict(foo="a b", pat="*")
+    assert pex.expand("${bar:-'$foo c'}", env=env) == "$foo c"
+    assert pex.expand('${bar:-"$foo c"}', env=env) == "a b c"
+    assert pex.expand('${foo%"$pat"}', env=dict(foo="ab*", pat="*")) == "ab"
+
+
+def test_expand_leaves_unterminated_or_empty_braces_unchanged():
+    assert pex.expand("${foo", env=dict(foo="bar")) == "${foo"
+    assert pex.expand("${}$foo", env=dict(foo="bar")) == "${}bar"
+
+
+def test_compile_returns_a_reusable_template():
+    template = pex.compile("${pkgname%-*}-${pkgver:-0}")
+    assert template is pex.compile("${pkgname%-*}-${pkgver:-0}")
+    assert template.expand(dict(pkgname="foo-bar", pkgver="1")) == "foo-1"
+    assert template.expand(dict(pkgname="baz-qux")) == "baz-0"
+
+
+def test_compile_raises_on_bad_substitution():
+    with pytest.raises(parameter_expansion.pe.ParameterExpansionParseError):
+        pex.compile("${foo!bar}")
+
+
+def test_dump_and_load_templates(tmp_path, monkeypatch):
+    path = tmp_path / "templates.bin"
+    sources = ["${foo:-bar}", "${foo%.*}/$bar", "plain"]
+    pex.dump_templates(path, sources)
+
+    monkeypatch.setattr(parameter_expansion.pe, "_cache", {})
+    monkeypatch.setattr(parameter_expansion.pe, "_loaded", {})
+
+    def fail(s):
+        raise AssertionError(f"{s!r} should not be parsed")
+
+    monkeypatch.setattr(parameter_expansion.pe, "_parse", fail)
+    assert pex.load_templates(path) == 3
+    env = dict(foo="a.b", bar="c")
+    assert pex.expand("${foo%.*}/$bar", env=env) == "a/c"
+    assert pex.compile("plain").expand(env) == "plain"
+
+
+def test_load_templates_ignores_other_cache_versions(tmp_path):
+    path = tmp_path / "templates.bin"
+    pex.dump_templates(path, ["${foo}"])
+    data = path.read_bytes()
+    path.write_bytes(data[:4] + b"\xff\xff" + data[6:])
+    assert pex.load_templates(path) == 0
+
+    path.write_bytes(b"garbage")
+    with pytest.raises(ValueError):
+        pex.load_templates(path)
+
+
+def test_expand_script_evaluates_assignments_in_order():
+    script = "\n".join(
+        [
+            "pkgname=foo",
+            'export pkgver="1.2 beta"',
+            "# $pkgname is not expanded in comments",
+            "_dir='$pkgname'-${pkgver% *}",
+            ": ${prefix:=/usr}",
+            "echo $prefix/$pkgname",
+        ]
+    )
+    env = dict(pkgname="bar")
+    final_env, lines = pex.expand_script(script, env=env)
+    assert env == dict(pkgname="bar")
+    assert final_env == dict(
+        pkgname="foo",
+        pkgver="1.2 beta",
+        _dir="$pkgname-1.2",
+        prefix="/usr",
+    )
+    assert lines == [
+        "pkgname=foo",
+        "export pkgver=1.2 beta",
+        "# $pkgname is not expanded in comments",
+        "_dir=$pkgname-1.2",
+        ": /usr",
+        "echo /usr/foo",
+    ]
+
+
+array_test_cases = [
+    Case(
+        tested_shell="-${parameter[1]}-${parameter[-1]}-$parameter-",
+        env={"parameter": ["aa", "bb", "cc"]},
+        expected_str="-bb-cc-aa-",
+    ),
+    Case(
+        tested_shell="-${parameter[@]}-${parameter[*]%?}-",
+        env={"parameter": ["aa", "bb", "cc"]},
+        expected_str="-aa bb cc-a b c-",
+    ),
+    Case(
+        tested_shell="-${#parameter[@]}-${#parameter[2]}-${!parameter[@]}-",
+        env={"parameter": ["aa", "bb", "ccc"]},
+        expected_str="-3-3-0 1 2-",
+    ),
+    Case(
+        tested_shell="-${parameter[@]:1:2}-${parameter[3]:-word}-",
+        env={"parameter": ["aa", "bb", "cc", ""]},
+        expected_str="-bb cc-word-",
+    ),
+    Case(
+        tested_shell="-${parameter[$word]}-${!parameter[@]}-",
+        env={"parameter": {"key": "value", "other": "x"}, "word": "key"},
+        expected_str="-value-key other-",
+    ),
+    Case(
+        tested_shell="-${parameter[0]}-${parameter[1]}-${parameter[@]}-",
+        env={"parameter": "set"},
+        expected_str="-set--set-",
+    ),
+]
+
+indirect_test_cases = [
+    Case(
+        tested_shell="-${!parameter}-${!parameter%d}-",
+        env={"parameter": "word", "word": "word"},
+        expected_str="-word-wor-",
+    ),
+    Case(
+        tested_shell="-${!parameter}-${!unset:-word}-",
+        env={"parameter": "array[1]", "array": ["aa", "bb"]},
+        expected_str="-bb-word-",
+    ),
+    Case(
+        tested_shell="-${!para*}-${!param@}-${!none*}-",
+        env={"parameter": "", "param": "", "paradox": "", "word": ""},
+        expected_str="-paradox param parameter-param parameter--",
+    ),
+]
+
+
+@pytest.mark.parametrize("test", array_test_cases + indirect_test_cases)
+def test_array_and_indirect(test):
+    assert pex.expand(test.tested_shell, env=test.env) == test.expected_str
+
+
+def test_expand_array_assignment():
+    env = {"parameter": ["aa"]}
+    assert pex.expand("${parameter[2]:=cc}", env=env) == "cc"
+    # unlike bash arrays, lists are not sparse
+    assert env == {"parameter": ["aa", "", "cc"]}
+
+
+def test_expand_script_assigns_arrays():
+    script = 'sources=("$pkgname a.tgz" b.patch)\necho ${sources[0]% *}'
+    env, lines = pex.expand_script(script, env={"pkgname": "foo"})
+    assert env["sources"] == ["foo a.tgz", "b.patch"]
+    assert lines == ["sources=(foo a.tgz b.patch)", "echo foo"]
+
+
+def test_expand_script_assigns_multiline_arrays():
+    script = (
+        "source=( # sources\n"
+        '  "$pkgname.tar"  # the (main) tarball\n'
+        "  b.patch 'c #d'\n"
+        ")\n"
+        "echo ${source[0]} ${#source[@]}\n"
+        "bad=(unterminated\n"
+        "echo $bad"
+    )
+    env, lines = pex.expand_script(script, env={"pkgname": "foo"})
+    assert env == {"pkgname": "foo", "source": ["foo.tar", "b.patch", "c #d"]}
+    assert lines == [
+        "source=(foo.tar b.patch c #d)",
+        "echo foo.tar 3",
+        "bad=(unterminated",
+        "echo $bad",
+    ]
+
+
+def test_expand_script_values_end_at_unquoted_blanks_and_operators():
+    script = (
+        'FOO="a b"  # comment\n'
+        "BAR=x; echo $BAR $FOO\n"
+        "BAZ=${BAR:-a b}\n"
+        'arr=(a "b c")  # comment'
+    )
+    env, lines = pex.expand_script(script, env={})
+    assert env == {"FOO": "a b", "BAR": "x", "BAZ": "x", "arr": ["a", "b c"]}
+    assert lines == [
+        "FOO=a b  # comment",
+        "BAR=x; echo x a b",
+        "BAZ=x",
+        "arr=(a b c)  # comment",
+    ]
+
+
+def test_expand_file(tmp_path):
+    src = tmp_path / "manifest.in"
+    dst = tmp_path / "manifest"
+    text = (
+        "name: $name\n"
+        "plain line \xe9\n"
+        "version: ${version:-1.0} ${dir:=/opt/$name}\n"
+        "cost: 5$ ${}\n"
+        "args: ${name:+--name\n$name}\n"
+        "unterminated: ${name"
+    )
+    src.write_text(text, encoding="utf-8")
+    env = {"name": "foo"}
+    pex.expand_file(src, dst, env=env)
+    assert dst.read_text(encoding="utf-8") == pex.expand(text, env={"name": "foo"})
+    assert env == {"name": "foo", "dir": "/opt/foo"}
+
+    text = "${x!y} $y\n${a + b} ${y}\n"
+    src.write_text(text, encoding="utf-8")
+    pex.expand_file(src, dst, env={"y": "2"}, dialect="envsubst")
+    expected = pex.expand(text, env={"y": "2"}, dialect="envsubst")
+    assert dst.read_text(encoding="utf-8") == expected == "${x!y} 2\n${a + b} 2\n"
+
+
+def test_expand_file_parses_expansions_across_windows(tmp_path):
+    src = tmp_path / "data.in"
+    dst = tmp_path / "data"
+    text = "a" * 250 + "$foobar ${foo:-" + "x" * 1000 + "} ${foo@" + "$foo"
+    src.write_text(text, encoding="utf-8")
+    with pytest.raises(pex.pe.ParameterExpansionParseError):
+        pex.expand_file(src, dst, env={"foo": "y"})
+    text = text.replace("${foo@", "${foo@U}")
+    src.write_text(text, encoding="utf-8")
+    pex.expand_file(src, dst, env={"foo": "y"})
+    assert dst.read_text(encoding="utf-8") == pex.expand(text, env={"foo": "y"})
+
+
+def test_expand_file_memory_does_not_depend_on_line_size(tmp_path):
+    tracemalloc = pytest.importorskip("tracemalloc")
+    src = tmp_path / "data.in"
+    dst = tmp_path / "data"
+    src.write_bytes(b"a" * (4 << 20) + b" $x " + b"b" * (4 << 20))
+    tracemalloc.start()
+    try:
+        pex.expand_file(src, dst, env={"x": "y"})
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert peak < 1 << 20
+    assert dst.stat().st_size == (8 << 20) + 3
+
+
+def test_expand_file_does_not_use_the_compile_cache(tmp_path):
+    template = pex.compile("${mine}")
+    src = tmp_path / "data.in"
+    dst = tmp_path / "data"
+    src.write_text("".join(f"$x {i} ${{y{i}}}\n" for i in range(5000)))
+    pex.expand_file(src, dst, env={"x": "z"})
+    assert pex.compile("${mine}") is template
+    assert dst.read_text().startswith("z 0 \nz 1 \n")
+
+
+def test_expand_file_copies_bytes_around_expansions(tmp_path):
+    src = tmp_path / "data.in"
+    dst = tmp_path / "data"
+    src.write_bytes(b"\xff\x00 $foo \xfe\n")
+    pex.expand_file(src, dst, env={"foo": "\xe9"})
+    assert dst.read_bytes() == b"\xff\x00 \xc3\xa9 \xfe\n"
+
+    src.write_bytes(b"")
+    pex.expand_file(src, dst, env={})
+    assert dst.read_bytes() == b""
+
+    with pytest.raises(ValueError):
+        pex.expand_file(src, src, env={})
+
+
+# test Bash case modification and transformations
+case_test_cases = [
+    Case(
+        tested_shell="-${parameter^}-${parameter^^}-",
+        env={"parameter": "aa bb"},
+        expected_str="-Aa bb-AA BB-",
+    ),
+    Case(
+        tested_shell="-${parameter,}-${parameter,,}-",
+        env={"parameter": "AA BB"},
+        expected_str="-aA BB-aa bb-",
+    ),
+    Case(
+        tested_shell="-${parameter^^[ab]}-${parameter^[b]}-${parameter^[a]}-",
+        env={"parameter": "aa bc"},
+        expected_str="-AA Bc-aa bc-Aa bc-",
+    ),
+    Case(
+        tested_shell="-${parameter[@]^}-",
+        env={"parameter": ["aa", "bb"]},
+        expected_str="-Aa Bb-",
+    ),
+    Case(
+        tested_shell="-${parameter@U}-${parameter@u}-${parameter@L}-",
+        env={"parameter": "aA bB"},
+        expected_str="-AA BB-AA bB-aa bb-",
+    ),
+    Case(
+        tested_shell="-${parameter@Q}-",
+        env={"parameter": "it's"},
+        expected_str="-'it'\\''s'-",
+    ),
+    Case(
+        tested_shell="-${parameter@E}-",
+        env={"parameter": "a\\tb\\x41\\101\\\\"},
+        expected_str="-a\tbAA\\-",
+    ),
+]
+
+
+@pytest.mark.parametrize("test", case_test_cases)
+def test_case(test):
+    assert pex.expand(test.tested_shell, env=test.env) == test.expected_str
+
+
+def test_template_expand_values():
+    values = ["foo", "bar"]
+    assert pex.compile("${PN^^}").expand_values("PN", values) == ["FOO", "BAR"]
+    template = pex.compile("${PN^}-${PV:-0}")
+    assert template.expand_values("PN", values, env={}) == ["Foo-0", "Bar-0"]
+    template = pex.compile("${o:=$PN}-$o")
+    assert template.expand_values("PN", ["a", "b"], env={}) == ["a-a", "b-b"]
+    values = ["foo", None]
+    assert pex.compile("${PN^^}").expand_values("PN", values) == ["FOO", ""]
+    template = pex.compile("${PN^^}${PV-}")
+    assert template.expand_values("PN", values, env={}) == ["FOO", ""]
+    for s in ("${PN^^}", "${PN^^}${PV-}"):
+        with pytest.raises(pex.ParameterExpansionNullError):
+            pex.compile(s).expand_values("PN", values, env={}, strict=True)
+
+
+# test arithmetic expansion
+arithmetic_test_cases = [
+    Case(
+        tested_shell="-$((parameter+1))-$(( (1 + 2) * 3 ))-",
+        env={"parameter": "3"},
+        expected_str="-4-9-",
+    ),
+    Case(
+        tested_shell="-$((-7 / 2))-$((-7 % 3))-$((-2 ** 2))-$((2 ** 3 ** 2))-",
+        env={},
+        expected_str="--3--1-4-512-",
+    ),
+    Case(
+        tested_shell="-$((0x1F + 010 + 2#101))-$((9223372036854775807 + 1))-",
+        env={},
+        expected_str="-44--9223372036854775808-",
+    ),
+    Case(
+        tested_shell="-$((parameter > 2 ? 1 : 0))-$((!parameter || word))-",
+        env={"parameter": "3", "word": ""},
+        expected_str="-1-0-",
+    ),
+    Case(
+        tested_shell="-$((parameter++))-$((parameter *= 2))-$parameter-",
+        env={"parameter": "3"},
+        expected_str="-3-8-8-",
+    ),
+    Case(
+        tested_shell="-$((parameter[1] + word))-${parameter[@]:$((1 - 1)):word}-",
+        env={"parameter": ["1", "2", "3"], "word": "parameter + 1"},
+        expected_str="-4-1 2-",
+    ),
+    Case(
+        tested_shell="-$(( $parameter + ${parameter} ))-$((unset))-",
+        env={"parameter": "3"},
+        expected_str="-6-0-",
+    ),
+]
+
+
+@pytest.mark.parametrize("test", arithmetic_test_cases)
+def test_arithmetic(test):
+    assert pex.expand(test.tested_shell, env=test.env) == test.expected_str
+
+
+@pytest.mark.parametrize(
+    "expression", ["$((1 / 0))", "$((1 +))", "$((1 = 2))", "$((digit))"]
+)
+def test_arithmetic_raises_on_errors(expression):
+    with pytest.raises(parameter_expansion.pe.ParameterExpansionParseError):
+        pex.expand(expression, env={"digit": "\xb2"})
+
+
+@pytest.mark.skipif(not shutil.which("bash"), reason="bash is not available")
+def test_expand_matches_bash():
+    import fuzz_pe
+
+    assert fuzz_pe.fuzz(budget=30, seed=42, max_cases=400) == []
+
+
+def test_replace_anchored_and_slash_patterns():
+    env = dict(parameter="/aa/bb/aa")
+    assert pex.expand("${parameter/#\\/aa/zz}", env=env) == "zz/bb/aa"
+    assert pex.expand("${parameter/%aa/zz}", env=env) == "/aa/bb/zz"
+    assert pex.expand("${parameter/#bb/zz}", env=env) == "/aa/bb/aa"
+    assert pex.expand("${parameter///}", env=env) == "aabbaa"
+    assert pex.expand("${unset/#/zz}${parameter@Q}${unset@Q}", env=env) == "'/aa/bb/aa'"
+
+
+def test_expander_does_not_update_env():
+    env = {"parameter": "set", "array": ["aa"]}
+    expander = pex.Expander(env=env)
+    assert expander.expand("${word:=word}-$word-${array[1]:=bb}") == "word-word-bb"
+    assert expander.expand("${parameter:=word}$word") == "set$word"
+    assert env == {"parameter": "set", "array": ["aa"]}
+
+
+def test_expander_is_shared_by_threads():
+    from concurrent.futures import ThreadPoolExecutor
+
+    expander = pex.Expander(env={}, strict=True, maxcache=8)
+
+    def expand(i):
+        return expander.expand("${word:=$((%d * 2))}-${word%%0}-${#word}" % i)
+
+    def expected(i):
+        word = str(i * 2)
+        return f"{word}-{word[:-1] if word.endswith('0') else word}-{len(word)}"
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(expand, range(1000)))
+    assert results == [expected(i) for i in range(1000)]
+    assert expander.env == {}
+    # the Expander has its own bounded caches of arithmetic and patterns
+    caches = expander._caches
+    assert "999 * 2" in caches.arithmetic and len(caches.arithmetic) <= 8
+    assert "999 * 2" not in parameter_expansion.pe._caches.arithmetic
+    assert list(caches.matchers) == ["0"]
+
+
+def test_repeated_expansions_are_computed_once(monkeypatch):
+    calls = []
+    remove_affix = parameter_expansion.pe._remove_affix
+
+    def counting_remove_affix(*args):
+        calls.append(args)
+        return remove_affix(*args)
+
+    monkeypatch.setattr(parameter_expansion.pe, "_remove_affix", counting_remove_affix)
+    env = dict(PV="1.2.3")
+    s = "${PV%.*}:${PV%.*}:${PV%%.*}:${x:-${PV%.*}}"
+    assert pex.expand(s, env=env) == "1.2:1.2:1:1.2"
+    assert len(calls) == 2
+    assert pex.expand(s, env=env) == "1.2:1.2:1:1.2"
+    assert len(calls) == 4
+
+
+def test_repeated_expansions_see_assignments():
+    env = dict(i="0")
+    assert pex.expand("$((i += 1))$((i += 1))", env=env) == "12"
+    assert pex.expand("${foo%.*}${foo:=a.b}${foo%.*}", env=env) == "a.ba"
+    assert pex.expand("${PV#*.}${PV:=1.2}${PV#*.}${PV#*.}", env={}) == "1.222"
+
+
+def test_expand_with_spans():
+    env = dict(foo="a.b", bar="c", i="1")
+    s = "x${foo%.*}$ $bar$((i + 1))${unset:-${bar}}"
+    expanded, spans = pex.expand_with_spans(s, env=env)
+    assert expanded == pex.expand(s, env=env) == "xa$ c2c"
+    assert [(s[a:b], expanded[c:d]) for a, b, c, d in spans] == [
+        ("x", "x"),
+        ("${foo%.*}", "a"),
+        ("$ ", "$ "),
+        ("$bar", "c"),
+        ("$((i + 1))", "2"),
+        ("${unset:-${bar}}", "c"),
+    ]
+    assert pex.expand_with_spans("", env=env) == ("", [])
+
+
+@pytest.mark.parametrize(
+    "template",
+    [
+        "$name-${version:-0}.tar",
+        "${name-x}${version+set}${version:+set}{}",
+        "${name%.*}:${name##*.}:${name/./-}:${name:1:2}:${name^^}:${version@Q}",
+        "$HOME/${name:=default}/$name",
+        "${version:-$name}",
+        "$namespace",
+        "plain",
+    ],
+)
+def test_expand_column_matches_expand(template):
+    columns = {"name": ["foo.tar.gz", "", None, "x.y"], "version": ["1", "", None, "2"]}
+    env = {"HOME": "/home/user", "namespace": "ns"}
+    expected = []
+    for row in zip(*columns.values()):
+        row_env = dict(env)
+        row_env.update((k, v) for k, v in zip(columns, row) if v is not None)
+        expected.append(pex.expand(template, env=row_env))
+    assert pex.expand_column(template, columns, env=env) == expected
+    assert env == {"HOME": "/home/user", "namespace": "ns"}
+
+
+def test_expand_column_errors():
+    with pytest.raises(ValueError):
+        pex.expand_column("$a$b", {"a": ["1", "2"], "b": ["1"]})
+    with pytest.raises(pex.ParameterExpansionNullError):
+        pex.expand_column("${a:-0}$b", {"a": [None], "b": [None]}, env={}, strict=True)
+    assert pex.expand_column("${a:-0}", {"a": [None]}, env={}, strict=True) == ["0"]
+
+
+def test_expand_column_with_numpy_arrays():
+    numpy = pytest.importorskip("numpy")
+    columns = {"name": numpy.array(["foo", "bar"]), "version": numpy.array(["1", ""])}
+    expanded = pex.expand_column("{$name}-${version:-0}", columns, env={})
+    assert isinstance(expanded, numpy.ndarray)
+    assert expanded.tolist() == ["{foo}-1", "{bar}-0"]
+    assert pex.expand_column("${name%o}", columns, env={}) == ["fo", "bar"]
+
+
+def test_expand_column_missing_values_are_unset():
+    nan = float("nan")
+    columns = {"name": ("foo", nan, "bar"), "v": ["1", "2", None]}
+    assert pex.expand_column("$name-${v}", columns, env={}) == [
+        "foo-1",
+        "$name-2",
+        "bar-",
+    ]
+    assert pex.expand_column("${name:-x}", columns, env={}) == ["foo", "x", "bar"]
+    assert pex.expand_column("${name%o}", columns, env={}) == ["fo", "", "bar"]
+    with pytest.raises(TypeError):
+        pex.expand_column("$name", {"name": ["foo", 1]}, env={})
+
+
+def test_expand_column_with_pandas_series():
+    pandas = pytest.importorskip("pandas")
+    columns = {
+        "name": pandas.Series(["foo", None, "bar"], index=[2, 0, 1]),
+        "v": pandas.Series(["1", pandas.NA, "3"], dtype=object),
+    }
+    assert pex.expand_column("${name:-x}-${v-y}", columns, env={}) == [
+        "foo-1",
+        "x-y",
+        "bar-3",
+    ]
+    with pytest.raises(pex.ParameterExpansionNullError):
+        pex.expand_column("${name%o}", columns, env={}, strict=True)
+
+
+def test_expansion_stats_count_each_path():
+    pex.expansion_stats(reset=True, enable=True)
+    env = dict(foo="bar", array=["a", "b"])
+    assert pex.expand("no expansion", env=env) == "no expansion"
+    assert pex.expand("$ {}", env=env) == "$ {}"
+    assert pex.expand("$foo/${foo}", env=env) == "bar/bar"
+    assert pex.expand("$array", env=env) == "a"
+    assert pex.expand("$foobar", env=env) == "barbar"
+    assert pex.expand("${foo%r}", env=env) == "ba"
+    assert pex.expansion_stats(reset=True) == dict(literal=2, simple=1, general=3)
+    assert pex.expansion_stats(enable=False) == dict(literal=0, simple=0, general=0)
+    assert pex.expand("$foo", env=env) == "bar"
+    assert pex.expansion_stats() == dict(literal=0, simple=0, general=0)
+    with pytest.raises(pex.ParameterExpansionNullError):
+        pex.expand("${unset}", env=env, strict=True)
+
+
+def test_validate_collects_all_problems():
+    env = dict(empty="", ref="missing")
+    s = "${a:-$b}\n$((1 / 0)) ${c:=1}$c ${empty:?is null} ${!ref} ${d!}"
+    assert pex.validate(s, env=env) == [
+        ("unset", "b", 0, 8, "parameter not set"),
+        ("parse", None, 9, 19, "Division by 0"),
+        ("null", "empty", 30, 47, "is null"),
+        ("unset", "missing", 48, 55, "parameter not set"),
+        ("parse", None, 56, 61, "Bad substitution: ${d!"),
+    ]
+    assert env == dict(empty="", ref="missing")
+    assert pex.validate("$foo ${foo:-$bar} plain", env=dict(foo="x")) == []
+
+
+def test_freeze():
+    env = dict(foo="bar", fo="x", array=["a", "b"], prefix_a="1", prefix_b="2")
+    frozen = pex.freeze(env)
+    assert isinstance(frozen, pex.FrozenEnv)
+    assert pex.freeze(frozen) is frozen
+    assert frozen == env
+    assert frozen.names == sorted(env)
+    assert frozen.longest_name("foobar") == "foo"
+    assert frozen.longest_name("fob") == "fo"
+    assert frozen.longest_name("bar") is None
+    s = "$foobar-${!prefix_*}-$arrays-${array[1]}-$unset"
+    expected = "barbar-prefix_a prefix_b-as-b-$unset"
+    assert pex.expand(s, env=frozen) == pex.expand(s, env=env) == expected
+
+    for s in ["${foo:=x}${new:=x}", "$((new = 1))", "${array[5]:=x}"]:
+        with pytest.raises(TypeError):
+            pex.expand(s, env=frozen)
+    with pytest.raises(TypeError):
+        frozen["foo"] = "baz"
+    assert frozen == env
+
+    expander = pex.Expander(env=frozen)
+    s = "${new:=x}$new ${!prefix*} ${array[2]:=c}"
+    assert expander.expand(s) == "xx prefix_a prefix_b c"
+    assert frozen == env and frozen.names == sorted(env)
+
+
+def test_prefix_names_include_assignments():
+    s = "${!prefix*}-${prefix_a:=a}-${!prefix_*}"
+    env = {"prefix_b": "b", "other": "o"}
+    expander = pex.Expander(env=pex.freeze(env))
+    assert pex.expand(s, env=env) == "prefix_b-a-prefix_a prefix_b"
+    assert expander.expand(s) == "prefix_b-a-prefix_a prefix_b"
+
+
+def test_freeze_copy_and_pickle():
+    frozen = pex.freeze(dict(foo="bar", array=["a", "b"]))
+    copies = [
+        copy.copy(frozen),
+        copy.deepcopy(frozen),
+        pickle.loads(pickle.dumps(frozen)),
+    ]
+    for copied in copies:
+        assert isinstance(copied, pex.FrozenEnv)
+        assert copied == frozen and copied.names == frozen.names
+        assert pex.expand("$foobar ${!f*}", env=copied) == "barbar foo"
+    assert copies[1]["array"] is not frozen["array"]
+
+
+def test_backend():
+    # run the tests with PARAMETER_EXPANSION_BACKEND=python or compiled to
+    # check the parity of the backends, see the mypyc tox environment
+    backend = os.environ.get("PARAMETER_EXPANSION_BACKEND") or pex.pe.BACKEND
+    assert pex.pe.BACKEND == backend
+    core = parameter_expansion.pe._core
+    assert pex.pe.ParameterExpansionParseError is core.ParameterExpansionParseError
+    compiled = not core.__file__.endswith(".py")
+    assert compiled == (backend == "compiled")
+
+
+dialect_test_cases = [
+    ("posix", "$foobar|${unset:-$foo}|${foo%r}|${#foo}|$((1 + 2))", "|bar|ba|3|3"),
+    ("posix", "${unset:=$foo}$unset", "barbar"),
+    (
+        "compose",
+        "$$HOME $$$foo ${unset:-${foo}} ${foo:+x} ${unset-$HOME}",
+        "$HOME $bar bar x /h",
+    ),
+    (
+        "envsubst",
+        "$foo ${foo} ${foo:-x} $((1)) ${a:-$foo} $unset ${foo!x}",
+        "bar bar ${foo:-x} $((1)) ${a:-bar}  ${foo!x}",
+    ),
+    ("envsubst", "$1 ${#} $# $$foo", "$1 ${#} $# $bar"),
+    ("posix", "~/$1${2:-x} $# ${#@}", "/h/x 0 0"),
+    ("bash", "$$foo $unset", f"{os.getpid()}foo $unset"),
+]
+
+
+@pytest.mark.parametrize("dialect,s,expected", dialect_test_cases)
+def test_dialect(dialect, s, expected):
+    env = dict(foo="bar", HOME="/h")
+    assert pex.expand(s, env=env, dialect=dialect) == expected
+    assert pex.Expander(env=env, dialect=dialect).expand(s) == expected
+
+
+@pytest.mark.parametrize(
+    "dialect,s",
+    [
+        ("posix", "${foo/a/b}"),
+        ("posix", "${foo:1}"),
+        ("posix", "${foo[1]}"),
+        ("posix", "${!foo}"),
+        ("posix", "${foo^^}"),
+        ("compose", "${foo=x}"),
+        ("compose", "${foo%x}"),
+        ("compose", "$((1))"),
+    ],
+)
+def test_dialect_raises_on_unsupported_expansions(dialect, s):
+    with pytest.raises(parameter_expansion.pe.ParameterExpansionParseError):
+        pex.compile(s, dialect)
+
+
+def test_dialect_errors_and_spans(tmp_path):
+    with pytest.raises(pex.ParameterExpansionNullError, match="foo: is required"):
+        pex.expand("${foo:?is required}", env={}, dialect="compose")
+    for s in ("$foo", "foo", "~"):
+        with pytest.raises(ValueError, match="Unknown dialect"):
+            pex.expand(s, env={}, dialect="zsh")
+        with pytest.raises(ValueError, match="Unknown dialect"):
+            pex.compile(s, "zsh")
+    template = pex.compile("a$$b$foo", "compose")
+    assert template is pex.compile("a$$b$foo", "compose")
+    assert template is not pex.compile("a$$b$foo")
+    expanded = ("a$bc", [(0, 4, 0, 3), (4, 8, 3, 4)])
+    assert template.expand_with_spans(dict(foo="c")) == expanded
+    with pytest.raises(ValueError):
+        pex.dump_templates(tmp_path / "templates.bin", [template])
+
+
+ARGV = ["zero", "a", "bb", "c", "d", "e", "f", "g", "h", "i", "j"]
+
+# tests positional and special parameters, checked against bash
+positional_test_cases = [
+    ("$# $@ $*", "10 a bb c d e f g h i j a bb c d e f g h i j"),
+    ("$1$2 ${10} $10 $0", "abb j a0 zero"),
+    ("${#} ${#@} ${#*} ${#1} ${#2}", "10 10 10 1 2"),
+    ("${@:0:2}|${@:1:1}|${@: -1}|${*:9}", "zero a|a|j|i j"),
+    ("${1:-d} ${11:-d} ${11-unset} ${3+set} ${@%?}", "a d unset set  b        "),
+    ("${!#} ${!1:-indirect}", "j indirect"),
+    ("$? ${?} $$ ${$}", f"0 0 {os.getpid()} {os.getpid()}"),
+    ("$foo$1 ${foo$1}", "xa ya"),
+]
+
+
+@pytest.mark.parametrize("s,expected", positional_test_cases)
+def test_positional_and_special_parameters(s, expected):
+    env = {"foo": "x", "fooa": "ya"}
+    assert pex.expand(s, env=env, argv=ARGV) == expected
+    assert pex.Expander(env=env, argv=ARGV).expand(s) == expected
+
+
+def test_positional_parameters_without_argv():
+    assert pex.expand("$# [$@] $1 ${1} ${1:-x} $0", env={}) == "0 [] $1  x $0"
+    with pytest.raises(pex.ParameterExpansionNullError):
+        pex.expand("$1", env={}, strict=True)
+    with pytest.raises(pex.pe.ParameterExpansionParseError):
+        pex.expand("${1:=x}", env={}, argv=["zero"])
+    with pytest.raises(pex.pe.ParameterExpansionParseError):
+        pex.expand("$1", env={}, dialect="compose")
+
+    # non-ASCII digits are not positional parameters
+    assert pex.expand("${$x}", env={"x": "\xb2"}, argv=ARGV) == ""
+    problems = pex.validate("${$x}", env={"x": "\xb2"}, argv=ARGV)
+    assert problems == [pex.Problem("unset", "\xb2", 0, 5, "parameter not set")]
+
+
+def test_positional_parameters_use_the_fast_path():
+    pex.expansion_stats(reset=True, enable=True)
+    assert pex.expand("$1-${2}.$#", env={}, argv=["zero", "a", "b"]) == "a-b.2"
+    stats = pex.expansion_stats(reset=True, enable=False)
+    assert stats == {"literal": 0, "simple": 1, "general": 0}
+
+
+def test_positional_parameters_in_every_expansion_function(tmp_path):
+    argv = ["zero", "a", "b"]
+    expanded, spans = pex.expand_with_spans("$1-${2%b}c.$#", env={}, argv=argv)
+    assert expanded == "a-c.2"
+    assert spans == [
+        (0, 2, 0, 1),
+        (2, 3, 1, 2),
+        (3, 9, 2, 2),
+        (9, 11, 2, 4),
+        (11, 13, 4, 5),
+    ]
+    assert pex.validate("$1 ${3:?unset}", env={}, argv=argv) == [
+        pex.Problem("unset", "3", 3, 14, "unset")
+    ]
+    columns = {"name": ["x", "y"]}
+    assert pex.expand_column("$name$1", columns, env={}, argv=argv) == ["xa", "ya"]
+    assert pex.expand_column("${name}${2%b}", columns, argv=argv) == ["x", "y"]
+    template = pex.compile("$name-$1-${@}")
+    assert template.expand_values("name", ["x"], env={}, argv=argv) == ["x-a-a b"]
+    src = tmp_path / "args.in"
+    dst = tmp_path / "args"
+    src.write_text("$0 $1 ${2:-none} $#\n", encoding="utf-8")
+    pex.expand_file(src, dst, env={}, argv=argv)
+    assert dst.read_text(encoding="utf-8") == "zero a b 2\n"
+
+
+def test_tilde_expansion():
+    home = os.path.expanduser("~root")
+    env = {"HOME": "/h", "foo": "x"}
+    assert pex.expand("~", env=env) == "/h"
+    assert pex.expand("~/$foo", env=env) == "/h/x"
+    assert pex.expand("~root/a", env=env) == home + "/a"
+    assert pex.expand("~nosuchuser/a ~", env=env) == "~nosuchuser/a ~"
+    assert pex.expand("a~/b", env=env) == "a~/b"
+    assert pex.compile("~/$foo").expand_with_spans(env) == (
+        "/h/x",
+        [(0, 1, 0, 2), (1, 2, 2, 3), (2, 6, 3, 4)],
+    )
+    script = "dir=~/src\n~/bin/run $dir $@"
+    env, lines = pex.expand_script(script, env=env, argv=["run", "-v"])
+    assert lines == ["dir=/h/src", "/h/bin/run /h/src -v"]